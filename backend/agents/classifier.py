@@ -22,26 +22,54 @@ Usage:
 """
 
 import re
+from functools import lru_cache
 from typing import Optional
 
+try:
+    import ahocorasick  # pyahocorasick — optional C-backed multi-pattern matcher
+except ImportError:
+    ahocorasick = None
+
 
 # ─── Compiled patterns (module-level, compiled once) ──────────────
 
-_GREETING_RE = re.compile(
-    r"^(привет|здравствуй|хай|хелло|hello|hi|hey|yo|good\s*morning|"
+# Greeting + question folded into one anchored alternation: a single
+# engine traversal (via .match) replaces two separate searches, and
+# m.lastgroup tells which intent fired.  "quest" is listed first so that
+# "what is up ..." (matched by both) keeps the looser 30-word gate of
+# the question branch, as with the two separate patterns.
+_INTENT_RE = re.compile(
+    r"(?P<quest>(?:что\s+такое|как\s+работает|зачем|почему|объясни|расскажи|"
+    r"what\s+is|how\s+does|explain|tell\s+me\s+about|why\s+do)\b)"
+    r"|(?P<greet>(?:привет|здравствуй|хай|хелло|hello|hi|hey|yo|good\s*morning|"
     r"добр(?:ый|ое|ого)|как\s+дела|что\s+нового|кто\s+ты|"
-    r"what(?:'s|\s+is)\s+up)\b",
-    re.IGNORECASE,
-)
-
-_QUESTION_RE = re.compile(
-    r"^(что\s+такое|как\s+работает|зачем|почему|объясни|расскажи|"
-    r"what\s+is|how\s+does|explain|tell\s+me\s+about|why\s+do)\b",
+    r"what(?:'s|\s+is)\s+up)\b)",
     re.IGNORECASE,
 )
 
 _LIST_MARKERS_RE = re.compile(r"(\d+\.\s|\n-\s|\n\*\s)")
 
+_WORD_RE = re.compile(r"\S+")
+
+# The largest word-count threshold in the cascade is 120, so counting
+# can stop at 121 words no matter how long the message is.
+_WORD_COUNT_CAP = 121
+
+
+def _count_words(text: str, cap: int = _WORD_COUNT_CAP) -> int:
+    """Count words without materializing them (vs len(text.split())).
+
+    len(text.split()) allocates one str per word just to take the length;
+    finditer scans at C level and allocates nothing we keep. Counting
+    stops at `cap` — every threshold below it still compares exactly.
+    """
+    n = 0
+    for _ in _WORD_RE.finditer(text):
+        n += 1
+        if n >= cap:
+            break
+    return n
+
 
 # ─── Keyword sets ─────────────────────────────────────────────────
 
@@ -86,6 +114,14 @@ _COMPLEX_KEYWORDS = frozenset({
     "crud", "dashboard", "панель управлен",
 })
 
+# Short follow-up replies ("да", "ок!", "thanks") — compared against the
+# lowered message with trailing punctuation pre-stripped, one lookup.
+_SHORT_TOKENS = frozenset({
+    "да", "нет", "ага", "ок", "хорошо", "ладно", "дальше",
+    "покажи", "yes", "no", "ok", "sure", "next", "go",
+    "спасибо", "thanks", "thank you",
+})
+
 _QUICK_BUILD_KEYWORDS = frozenset({
     "одностраничник", "лендинг", "landing", "simple page",
     "one page", "one-page", "простой сайт", "простая страниц",
@@ -93,9 +129,77 @@ _QUICK_BUILD_KEYWORDS = frozenset({
 })
 
 
-def _kw_match(text_lower: str, keywords: frozenset) -> bool:
-    """Check if any keyword is found in the lowered text."""
-    return any(kw in text_lower for kw in keywords)
+def _kw_regex(keywords: frozenset[str]) -> re.Pattern:
+    """Compile a keyword set into one alternation pattern.
+
+    A single C-level regex scan replaces N Python-level `in` checks
+    (longest alternatives first, so e.g. "узнай погод" wins over "погод").
+    """
+    alts = sorted(keywords, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, alts)))
+
+
+# One precompiled pattern per keyword set (compiled once at import)
+_CODE_RE = _kw_regex(_CODE_KEYWORDS)
+_BROWSER_RE = _kw_regex(_BROWSER_KEYWORDS)
+_DEBUG_RE = _kw_regex(_DEBUG_KEYWORDS)
+_REVIEW_RE = _kw_regex(_REVIEW_KEYWORDS)
+_COMPLEX_RE = _kw_regex(_COMPLEX_KEYWORDS)
+_QUICK_BUILD_RE = _kw_regex(_QUICK_BUILD_KEYWORDS)
+
+# Set id → fallback pattern (used when pyahocorasick is not installed)
+_SET_PATTERNS = {
+    "code": _CODE_RE,
+    "browser": _BROWSER_RE,
+    "debug": _DEBUG_RE,
+    "review": _REVIEW_RE,
+    "complex": _COMPLEX_RE,
+    "quick_build": _QUICK_BUILD_RE,
+}
+
+
+def _build_automaton() -> Optional["ahocorasick.Automaton"]:
+    """Merge ALL keyword sets into one Aho–Corasick automaton.
+
+    One linear scan over the message reports every matching keyword and
+    which set it belongs to — O(|text| + matches) regardless of how many
+    keyword sets exist.
+    """
+    if ahocorasick is None:
+        return None
+    ac = ahocorasick.Automaton()
+    for set_id, keywords in (
+        ("code", _CODE_KEYWORDS),
+        ("browser", _BROWSER_KEYWORDS),
+        ("debug", _DEBUG_KEYWORDS),
+        ("review", _REVIEW_KEYWORDS),
+        ("complex", _COMPLEX_KEYWORDS),
+        ("quick_build", _QUICK_BUILD_KEYWORDS),
+    ):
+        for kw in keywords:
+            # The same keyword may belong to several sets
+            existing = ac.get(kw, None)
+            ac.add_word(kw, (existing or ()) + (set_id,))
+    ac.make_automaton()
+    return ac
+
+
+_AC = _build_automaton()
+
+
+def _scan_keyword_sets(text_lower: str) -> frozenset[str]:
+    """Which keyword sets match the lowered text (one pass with AC)."""
+    if _AC is not None:
+        hits = set()
+        for _, set_ids in _AC.iter(text_lower):
+            hits.update(set_ids)
+            if len(hits) == len(_SET_PATTERNS):
+                break
+        return frozenset(hits)
+    return frozenset(
+        set_id for set_id, pattern in _SET_PATTERNS.items()
+        if pattern.search(text_lower)
+    )
 
 
 def classify_task(
@@ -120,57 +224,93 @@ def classify_task(
     if images:
         return "vision"
 
-    text = message.strip()
+    # Classification is a pure function of (text, history bucket), so
+    # repeat calls (retries, parallel planners) become dict lookups.
+    # Only the head matters for rule matching — anything past 4 KB is
+    # "complex" territory anyway, and a bounded key keeps the cache small.
+    # The history bucket picks a specialized variant instead of riding
+    # along as a flag: the fresh-conversation variant carries no
+    # follow-up branch at all, and each variant caches independently.
+    text = message.strip()[:4096]
+    if history_len > 2:
+        return _classify_followup(text)
+    return _classify_fresh(text)
+
+
+@lru_cache(maxsize=1024)
+def _classify_followup(text: str) -> str:
+    """Variant for ongoing conversations: short replies count as follow-ups."""
+    if not text:
+        return "simple_chat"
     lower = text.lower()
-    word_count = len(text.split())
-
-    # ── Greetings (short + pattern match) ─────────────────────────
-    if word_count <= 15 and _GREETING_RE.search(lower):
-        # Unless it also contains code keywords ("привет, создай сайт")
-        if not _kw_match(lower, _CODE_KEYWORDS) and not _kw_match(lower, _BROWSER_KEYWORDS):
-            return "simple_chat"
+    word_count = _count_words(text)
 
     # ── Short follow-ups in existing conversations ────────────────
     # "да", "нет", "ага", "ок", "хорошо", "дальше", "покажи"
-    if word_count <= 3 and history_len > 2:
-        short_tokens = {"да", "нет", "ага", "ок", "хорошо", "ладно", "дальше",
-                        "покажи", "yes", "no", "ok", "sure", "next", "go",
-                        "спасибо", "thanks", "thank you"}
-        if lower in short_tokens or text.rstrip("!?.") in short_tokens:
+    # Decided before any keyword scan — a 2-word reply needs none.
+    if word_count <= 3 and lower.rstrip("!?.") in _SHORT_TOKENS:
+        return "simple_chat"
+
+    return _classify_cascade(lower, word_count)
+
+
+@lru_cache(maxsize=1024)
+def _classify_fresh(text: str) -> str:
+    """Variant for new conversations: the follow-up branch can never fire."""
+    # Cheap gate: empty message resolves without lowering or scanning
+    if not text:
+        return "simple_chat"
+    return _classify_cascade(text.lower(), _count_words(text))
+
+
+def _classify_cascade(lower: str, word_count: int) -> str:
+    """Shared rule cascade (both variants land here after their fast gates)."""
+    # One scan over the message classifies against all keyword sets at once
+    hits = _scan_keyword_sets(lower)
+
+    # One anchored attempt decides both greeting and question intent
+    intent_m = _INTENT_RE.match(lower)
+    intent = intent_m.lastgroup if intent_m else None
+
+    # ── Greetings (short + pattern match) ─────────────────────────
+    if word_count <= 15 and intent == "greet":
+        # Unless it also contains code keywords ("привет, создай сайт")
+        if "code" not in hits and "browser" not in hits:
             return "simple_chat"
 
     # ── General questions (no code keywords) ──────────────────────
     if (word_count <= 30
-            and _QUESTION_RE.search(lower)
-            and not _kw_match(lower, _CODE_KEYWORDS)
-            and not _kw_match(lower, _BROWSER_KEYWORDS)):
+            and intent == "quest"
+            and "code" not in hits
+            and "browser" not in hits):
         return "simple_chat"
 
     # ── Code review ───────────────────────────────────────────────
-    if _kw_match(lower, _REVIEW_KEYWORDS):
+    if "review" in hits:
         return "review"
 
     # ── Browser tasks ─────────────────────────────────────────────
-    if _kw_match(lower, _BROWSER_KEYWORDS):
+    if "browser" in hits:
         # If also has code keywords, it's probably coding with browser test
-        if _kw_match(lower, _COMPLEX_KEYWORDS):
+        if "complex" in hits:
             return "complex"
         return "browser"
 
     # ── Debug / fix ───────────────────────────────────────────────
-    if _kw_match(lower, _DEBUG_KEYWORDS):
+    if "debug" in hits:
         return "debug"
 
     # ── Quick build (one-pager) ───────────────────────────────────
-    if word_count <= 25 and _kw_match(lower, _QUICK_BUILD_KEYWORDS):
+    if word_count <= 25 and "quick_build" in hits:
         return "quick_build"
 
     # ── Complex task ──────────────────────────────────────────────
-    if _kw_match(lower, _COMPLEX_KEYWORDS):
+    if "complex" in hits:
         return "complex"
 
     # Long message with list markers → complex
-    if word_count > 40 and _LIST_MARKERS_RE.search(text):
+    # (markers are case-free, so the scan reuses `lower` like the rest)
+    if word_count > 40 and _LIST_MARKERS_RE.search(lower):
         return "complex"
 
     # Very long description → complex
@@ -178,7 +318,7 @@ def classify_task(
         return "complex"
 
     # ── Standard coding ───────────────────────────────────────────
-    if _kw_match(lower, _CODE_KEYWORDS):
+    if "code" in hits:
         return "coding"
 
     # ── Fallback ──────────────────────────────────────────────────
@@ -10,9 +10,20 @@ Usage:
     from agents.context import compress_tool_result, build_context_summary
 """
 
+import io
 import json
+import re
+import threading
 from typing import Optional
 
+# The fact/char caches below are shared across threads: engine offloads
+# build_context_summary to asyncio.to_thread while the event-loop thread
+# keeps running estimate_tokens against the same dicts. Single-key gets
+# and sets are atomic under the GIL, but an insert racing the prune
+# iteration raises "dictionary changed size during iteration" — so every
+# write and every prune takes this lock. Reads stay lock-free.
+_CACHE_LOCK = threading.Lock()
+
 
 # ─── Per-tool result size limits (chars) ──────────────────────────
 # Each tool type has a maximum result length.  Beyond it, content is
@@ -38,6 +49,36 @@ TOOL_RESULT_LIMITS = {
 }
 
 
+_FILEPATH_JSON_RE = re.compile(r'"filepath"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_SUCCESS_JSON_RE = re.compile(r'"success"\s*:\s*(true|false)')
+_COMMAND_JSON_RE = re.compile(r'"command"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_URL_JSON_RE = re.compile(r'"url"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_FAIL_JSON_RE = re.compile(r'"success"\s*:\s*false')
+
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+
+def _dumps_head(data: dict, limit: int) -> tuple[str, bool]:
+    """Serialize at most ~limit chars of `data` via incremental encoding.
+
+    json.dumps of a multi-MB browser result allocates the whole string
+    only to be sliced; iterencode lets us stop as soon as the limit is
+    crossed, bounding the work to `limit` chars regardless of input size.
+    Returns (text cut to limit, was_truncated).
+    """
+    buf = []
+    total = 0
+    for chunk in _JSON_ENCODER.iterencode(data):
+        buf.append(chunk)
+        total += len(chunk)
+        if total > limit:
+            break
+    out = "".join(buf)
+    if total > limit:
+        return out[:limit], True
+    return out, False
+
+
 # ─── Public API ───────────────────────────────────────────────────
 
 def compress_tool_result(tool_name: str, result_json: str) -> str:
@@ -59,30 +100,57 @@ def compress_tool_result(tool_name: str, result_json: str) -> str:
     if len(result_json) <= limit:
         return result_json
 
+    # ── Fast paths: skip JSON parsing for trivially compressible shapes ──
+    if tool_name == "write_file":
+        # Only the filepath survives compression — extract it by regex and
+        # rebuild the tiny result by templating, no loads/dumps round trip.
+        m = _FILEPATH_JSON_RE.search(result_json)
+        if m:
+            sm = _SUCCESS_JSON_RE.search(result_json)
+            ok = "false" if sm and sm.group(1) == "false" else "true"
+            return '{"success": %s, "result": {"filepath": "%s"}}' % (ok, m.group(1))
+    elif tool_name not in _COMPRESSORS:
+        # Tools without a specialized compressor end up re-serialized and
+        # sliced; slicing the incoming JSON directly is byte-identical
+        # (the engine produced it with the same json.dumps settings).
+        return result_json[:limit] + '... (truncated)'
+
     try:
         data = json.loads(result_json)
     except (json.JSONDecodeError, TypeError):
         return result_json[:limit] + '... (truncated)'
 
-    # ── Specialised compressors ───────────────────────────────────
-    if tool_name == "execute_command":
-        return _compress_command(data, limit)
+    # ── Specialised compressors (single dict lookup) ──────────────
+    return _COMPRESSORS.get(tool_name, _compress_generic)(data, limit)
 
-    if tool_name == "read_file":
-        return _compress_read_file(data, limit)
 
-    if tool_name in ("browser_screenshot", "browser_get_content",
-                      "browser_get_page_structure"):
-        return _compress_browser(data, limit)
+def compress_tool_result_dict(tool_name: str, result: dict) -> str:
+    """
+    Compress a tool result that is still a dict.
 
-    if tool_name in ("write_file", "write_files"):
-        return _compress_write(data, limit)
+    The engine holds the result as a dict right after execution, and the
+    specialized compressors work on parsed data anyway — feeding them the
+    dict directly skips the full-size serialize → scan → re-parse round
+    trip of the string API, so only the already-compressed form is ever
+    serialized.
 
-    # Default: serialize → slice
-    out = json.dumps(data, ensure_ascii=False)
-    if len(out) > limit:
-        out = out[:limit] + '... (truncated)'
-    return out
+    Args:
+        tool_name: Name of the tool that produced the result.
+        result:    The raw result dict ({"success": ..., "result": {...}}).
+
+    Returns:
+        Compressed JSON string.
+    """
+    limit = TOOL_RESULT_LIMITS.get(tool_name, 2000)
+
+    # Some compressors trim fields in place; the engine's dict is also
+    # referenced by the streamed AgentStep, so detach one level first.
+    data = dict(result)
+    r = data.get("result")
+    if isinstance(r, dict):
+        data["result"] = dict(r)
+
+    return _COMPRESSORS.get(tool_name, _compress_generic)(data, limit)
 
 
 def build_context_summary(messages: list[dict]) -> str:
@@ -104,62 +172,98 @@ def build_context_summary(messages: list[dict]) -> str:
     Returns:
         Multi-line summary string.
     """
-    goal = ""
-    files_written: list[str] = []
-    commands_run: list[str] = []
-    browser_urls: list[str] = []
-    errors: list[str] = []
-    last_assistant = ""
+    state = _new_summary_state()
 
     for m in messages:
-        role = m.get("role")
-
-        if role == "user":
-            text = (m.get("content") or "").strip()
-            if text and not goal:
-                goal = text[:300]
-
-        elif role == "assistant":
-            for tc in (m.get("tool_calls") or []):
-                fn = tc.get("function", {}) if isinstance(tc, dict) else {}
-                name = fn.get("name", "")
-                args_str = fn.get("arguments", "")
-                _extract_tool_facts(
-                    name, args_str,
-                    files_written, commands_run, browser_urls,
-                )
-            text = (m.get("content") or "").strip()
-            if text:
-                last_assistant = text[:200]
-
-        elif role == "tool":
-            _extract_tool_errors(m, errors)
+        handler = _SUMMARY_HANDLERS.get(m.get("role"))
+        if handler:
+            handler(m, state)
+
+    # Prune dead ids from the per-message fact cache when it outgrows
+    # any realistic history (same policy as the token-estimate cache)
+    if len(_FACTS_CACHE) > _FACTS_CACHE_MAX:
+        live = {id(m) for m in messages}
+        with _CACHE_LOCK:
+            for key in [k for k in _FACTS_CACHE if k not in live]:
+                del _FACTS_CACHE[key]
+
+    goal = state["goal"]
+    files_written = list(state["files"])  # insertion-ordered dict → list
+    commands_run = state["commands"]
+    browser_urls = state["urls"]
+    errors = state["errors"]
+    last_assistant = state["last_assistant"]
 
     # ── Assemble ──────────────────────────────────────────────────
-    parts: list[str] = []
+    # Written straight into one buffer — no intermediate f-strings or
+    # a parts list to join at the end.
+    buf = io.StringIO()
 
     if goal:
-        parts.append(f"ЗАДАЧА: {goal}")
+        buf.write("ЗАДАЧА: ")
+        buf.write(goal)
 
     if files_written:
-        recent = files_written[-12:]
-        extra = f" (ещё {len(files_written) - 12})" if len(files_written) > 12 else ""
-        parts.append(f"СОЗДАННЫЕ ФАЙЛЫ: {', '.join(recent)}{extra}")
+        if buf.tell():
+            buf.write("\n")
+        buf.write("СОЗДАННЫЕ ФАЙЛЫ: ")
+        buf.write(", ".join(files_written[-12:]))
+        if len(files_written) > 12:
+            buf.write(f" (ещё {len(files_written) - 12})")
 
     if commands_run:
-        recent = commands_run[-6:]
-        parts.append(f"ВЫПОЛНЕННЫЕ КОМАНДЫ: {'; '.join(recent)}")
+        if buf.tell():
+            buf.write("\n")
+        buf.write("ВЫПОЛНЕННЫЕ КОМАНДЫ: ")
+        buf.write("; ".join(commands_run[-6:]))
 
     if browser_urls:
-        parts.append(f"ОТКРЫТЫЕ URL: {', '.join(browser_urls[-3:])}")
+        if buf.tell():
+            buf.write("\n")
+        buf.write("ОТКРЫТЫЕ URL: ")
+        buf.write(", ".join(browser_urls[-3:]))
 
     if errors:
-        parts.append(f"ПОСЛЕДНИЕ ОШИБКИ: {' | '.join(errors[-3:])}")
+        if buf.tell():
+            buf.write("\n")
+        buf.write("ПОСЛЕДНИЕ ОШИБКИ: ")
+        buf.write(" | ".join(errors[-3:]))
 
     if last_assistant:
-        parts.append(f"ПОСЛЕДНИЙ ОТВЕТ МОДЕЛИ: {last_assistant}")
-
-    return "\n".join(parts) if parts else "Предыдущий диалог (сжато)."
+        if buf.tell():
+            buf.write("\n")
+        buf.write("ПОСЛЕДНИЙ ОТВЕТ МОДЕЛИ: ")
+        buf.write(last_assistant)
+
+    return buf.getvalue() or "Предыдущий диалог (сжато)."
+
+
+# Per-message char counts keyed by id(m).  The history grows one message
+# at a time while budget checks rescan everything, so caching makes each
+# estimate O(new messages) instead of O(whole history).  Entries store
+# the content/tool_calls objects themselves and are validated by
+# identity: that both catches in-place mutation (e.g. the system message
+# after plan injection) and makes id(m) reuse safe — CPython can recycle
+# a freed dict's id, but while an entry holds its objects alive a new
+# message can't alias them, so a stale hit is impossible.
+_MSG_CHARS: dict[int, tuple] = {}
+_MSG_CHARS_MAX = 4096
+
+
+def _message_chars(m: dict) -> int:
+    """Char count of one message (content + tool-call arguments), cached."""
+    c = m.get("content")
+    tool_calls = m.get("tool_calls") or ()
+    cached = _MSG_CHARS.get(id(m))
+    if cached is not None and cached[0] is c and cached[1] is tool_calls:
+        return cached[2]
+    total = len(c) if c else 0
+    for tc in tool_calls:
+        if isinstance(tc, dict):
+            total += len((tc.get("function") or {}).get("arguments") or "")
+    with _CACHE_LOCK:
+        _MSG_CHARS[id(m)] = (c, tool_calls, total)
+    return total
 
 
 def estimate_tokens(messages: list[dict]) -> int:
@@ -169,14 +273,18 @@ def estimate_tokens(messages: list[dict]) -> int:
     due to multi-byte encoding. We use a conservative ~2.5 chars/token for mixed text
     to avoid underestimating and hitting the model's context limit.
     """
-    total_chars = 0
+    total = 0
     for m in messages:
-        total_chars += len(m.get("content") or "")
-        for tc in (m.get("tool_calls") or []):
-            fn = tc.get("function", {}) if isinstance(tc, dict) else {}
-            total_chars += len(fn.get("arguments", ""))
-    # ~2.5 chars per token (conservative for mixed Cyrillic + English + code)
-    return int(total_chars / 2.5)
+        total += _message_chars(m)
+    # Prune dead ids once the cache outgrows any realistic history
+    if len(_MSG_CHARS) > _MSG_CHARS_MAX:
+        live = {id(m) for m in messages}
+        with _CACHE_LOCK:
+            for key in [k for k in _MSG_CHARS if k not in live]:
+                del _MSG_CHARS[key]
+    # ~2.5 chars per token (conservative for mixed Cyrillic + English + code);
+    # integer arithmetic avoids the float round-trip on this hot path
+    return total * 2 // 5
 
 
 def compress_recent_messages(messages: list[dict], per_msg_limit: int = 1500) -> list[dict]:
@@ -198,11 +306,46 @@ def compress_recent_messages(messages: list[dict], per_msg_limit: int = 1500) ->
 
 # ─── Private helpers ──────────────────────────────────────────────
 
+def _result_dict(data: dict) -> dict:
+    """The 'result' payload of a tool response ({} when it isn't a dict).
+
+    Every compressor needs this same unpack; one typed helper replaces
+    the .get/isinstance dance repeated in each of them.
+    """
+    r = data.get("result", data)
+    return r if isinstance(r, dict) else {}
+
+
+def _head_lines(s: str, n: int) -> str:
+    """First n lines of s, located by scanning for newlines.
+
+    str.split("\\n") materializes every line of a potentially multi-MB
+    string just to keep a handful; find/rfind walk at C level and only
+    the kept region is ever allocated.
+    """
+    i = -1
+    for _ in range(n):
+        j = s.find("\n", i + 1)
+        if j < 0:
+            return s
+        i = j
+    return s[:i]
+
+
+def _tail_lines(s: str, n: int) -> str:
+    """Last n lines of s (see _head_lines)."""
+    i = len(s)
+    for _ in range(n):
+        j = s.rfind("\n", 0, i)
+        if j < 0:
+            return s
+        i = j
+    return s[i + 1:]
+
+
 def _compress_command(data: dict, limit: int) -> str:
     """execute_command: keep exit_code, tail of stdout, full stderr."""
-    r = data.get("result", data)
-    if not isinstance(r, dict):
-        r = {}
+    r = _result_dict(data)
     exit_code = r.get("exit_code", -1)
     stdout = r.get("stdout", "")
     stderr = r.get("stderr", "")
@@ -214,11 +357,11 @@ def _compress_command(data: dict, limit: int) -> str:
 
     # stdout: head + tail
     if stdout and len(stdout) > half:
-        lines = stdout.split("\n")
-        if len(lines) > 10:
-            head = "\n".join(lines[:3])
-            tail = "\n".join(lines[-7:])
-            stdout = f"{head}\n... ({len(lines) - 10} lines omitted) ...\n{tail}"
+        n_lines = stdout.count("\n") + 1
+        if n_lines > 10:
+            head = _head_lines(stdout, 3)
+            tail = _tail_lines(stdout, 7)
+            stdout = f"{head}\n... ({n_lines - 10} lines omitted) ...\n{tail}"
         else:
             stdout = stdout[:half] + "... (truncated)"
 
@@ -232,19 +375,17 @@ def _compress_command(data: dict, limit: int) -> str:
 
 def _compress_read_file(data: dict, limit: int) -> str:
     """read_file: keep filepath, trim file content."""
-    r = data.get("result", data)
-    if not isinstance(r, dict):
-        r = {}
+    r = _result_dict(data)
     content = r.get("content", "")
     filepath = r.get("filepath", "")
 
     body_limit = limit - 200  # room for JSON wrapper
     if len(content) > body_limit:
-        lines = content.split("\n")
-        if len(lines) > 30:
-            head = "\n".join(lines[:15])
-            tail = "\n".join(lines[-10:])
-            content = f"{head}\n\n... ({len(lines) - 25} lines omitted) ...\n\n{tail}"
+        n_lines = content.count("\n") + 1
+        if n_lines > 30:
+            head = _head_lines(content, 15)
+            tail = _tail_lines(content, 10)
+            content = f"{head}\n\n... ({n_lines - 25} lines omitted) ...\n\n{tail}"
         else:
             content = content[:body_limit] + "\n... (truncated)"
 
@@ -256,7 +397,8 @@ def _compress_browser(data: dict, limit: int) -> str:
     """browser_screenshot / get_content / get_page_structure: trim page_text/elements."""
     r = data.get("result", data)
     if not isinstance(r, dict):
-        return json.dumps(data, ensure_ascii=False)[:limit] + "... (truncated)"
+        head, _ = _dumps_head(data, limit)
+        return head + "... (truncated)"
 
     body_limit = limit - 200
     for key in ("page_text", "text", "content"):
@@ -269,17 +411,15 @@ def _compress_browser(data: dict, limit: int) -> str:
         r["elements"] = r["elements"][:30]
         r["_note"] = f"Showing 30 of {total} elements"
 
-    out = json.dumps(data, ensure_ascii=False)
-    if len(out) > limit:
-        out = out[:limit] + "... (truncated)"
+    out, truncated = _dumps_head(data, limit)
+    if truncated:
+        out += "... (truncated)"
     return out
 
 
 def _compress_write(data: dict, limit: int) -> str:
     """write_file / write_files: minimal — just filepath and success."""
-    r = data.get("result", data)
-    if not isinstance(r, dict):
-        r = {}
+    r = _result_dict(data)
 
     # write_file
     if "filepath" in r:
@@ -303,29 +443,90 @@ def _compress_write(data: dict, limit: int) -> str:
     return json.dumps(data, ensure_ascii=False)[:limit]
 
 
+def _compress_generic(data: dict, limit: int) -> str:
+    """Fallback: serialize (bounded) → slice."""
+    out, truncated = _dumps_head(data, limit)
+    if truncated:
+        out += "... (truncated)"
+    return out
+
+
+# Registered once at import; compress_tool_result dispatches with a single
+# dict lookup instead of a cascade of string compares.  Adding a tool-
+# specific compressor is now just a new entry here.
+_COMPRESSORS = {
+    "execute_command":              _compress_command,
+    "read_file":                    _compress_read_file,
+    "write_file":                   _compress_write,
+    "write_files":                  _compress_write,
+    "browser_screenshot":           _compress_browser,
+    "browser_get_content":          _compress_browser,
+    "browser_get_page_structure":   _compress_browser,
+}
+
+
 def _extract_tool_facts(
     tool_name: str,
     args_str: str,
-    files_written: list[str],
+    files_written: dict[str, None],
     commands_run: list[str],
     browser_urls: list[str],
 ) -> None:
-    """Extract key facts from tool-call arguments for the summary."""
+    """Extract key facts from tool-call arguments for the summary.
+
+    Fast path: pull the single interesting field out of the raw argument
+    JSON by regex — write_file arguments can be several KB of content
+    that json.loads would parse just to read one key.  Falls back to a
+    full parse when the capture contains escape sequences (so values are
+    always stored decoded).
+
+    `files_written` is a dict used as an ordered set — inserting an
+    already-seen path is a no-op without a linear scan.
+    """
+    if not args_str:
+        return
+
+    if tool_name in ("write_file", "write_files"):
+        found = _FILEPATH_JSON_RE.findall(args_str)
+        if tool_name == "write_file":
+            found = found[:1]
+        if found and all("\\" not in fp for fp in found):
+            for fp in found:
+                if fp:
+                    files_written[fp] = None
+            return
+    elif tool_name == "execute_command":
+        m = _COMMAND_JSON_RE.search(args_str)
+        if m and "\\" not in m.group(1):
+            cmd = m.group(1)[:80]
+            if cmd:
+                commands_run.append(cmd)
+            return
+    elif tool_name == "browser_navigate":
+        m = _URL_JSON_RE.search(args_str)
+        if m and "\\" not in m.group(1):
+            url = m.group(1)[:100]
+            if url:
+                browser_urls.append(url)
+            return
+    else:
+        return  # no facts tracked for this tool — nothing to parse
+
     try:
-        args = json.loads(args_str) if args_str else {}
+        args = json.loads(args_str)
     except (json.JSONDecodeError, TypeError):
         return
 
     if tool_name == "write_file":
         fp = args.get("filepath", "")
-        if fp and fp not in files_written:
-            files_written.append(fp)
+        if fp:
+            files_written[fp] = None
 
     elif tool_name == "write_files":
         for f in (args.get("files") or []):
             fp = f.get("filepath", "") if isinstance(f, dict) else ""
-            if fp and fp not in files_written:
-                files_written.append(fp)
+            if fp:
+                files_written[fp] = None
 
     elif tool_name == "execute_command":
         cmd = args.get("command", "")[:80]
@@ -338,9 +539,119 @@ def _extract_tool_facts(
             browser_urls.append(url)
 
 
+# ─── Summary role handlers ────────────────────────────────────────
+# build_context_summary dispatches per-role through a table: one dict
+# lookup instead of chained role comparisons, and each handler can be
+# tuned (or replaced) independently.
+
+def _head_stripped(s: str, n: int) -> str:
+    """First n chars of s.strip(), without scanning a huge string.
+
+    strip() walks the whole string even when only the first 300 chars
+    survive; working on a 4n-char window bounds the cost when content is
+    very long (file dumps accidentally pasted into a message).  Falls
+    back to a full strip only when the window is mostly whitespace.
+    """
+    if len(s) <= n * 4:
+        return s.strip()[:n]
+    head = s[: n * 4].lstrip()
+    if len(head) >= n:
+        return head[:n]
+    return s.strip()[:n]
+
+
+def _new_summary_state() -> dict:
+    """Mutable accumulator threaded through the summary role handlers."""
+    return {
+        "goal": "",
+        # dict used as an ordered set: O(1) dedup of file paths vs the
+        # O(n) `not in list` scan that grew with every write_file call
+        "files": {},
+        "commands": [],
+        "urls": [],
+        "errors": [],
+        "last_assistant": "",
+    }
+
+
+def _summary_on_user(m: dict, state: dict) -> None:
+    if not state["goal"]:
+        text = _head_stripped(m.get("content") or "", 300)
+        if text:
+            state["goal"] = text
+
+
+# Facts extracted from a message never change once it is in history, but
+# the same old messages get re-summarized every time the context is
+# compacted.  Cache per-message facts keyed by id(m) so repeat summaries
+# only parse messages they haven't seen.  As with _MSG_CHARS, entries
+# store the content/tool_calls objects and validate by identity: holding
+# them alive makes a recycled dict id harmless — a stale hit would
+# otherwise inject another message's files/commands/errors into the
+# summary the LLM sees.
+_FACTS_CACHE: dict[int, tuple] = {}
+_FACTS_CACHE_MAX = 4096
+
+
+def _summary_on_assistant(m: dict, state: dict) -> None:
+    content = m.get("content") or ""
+    tool_calls = m.get("tool_calls") or ()
+
+    cached = _FACTS_CACHE.get(id(m))
+    if (cached is not None and cached[0] == "assistant"
+            and cached[1] is content and cached[2] is tool_calls):
+        files, commands, urls, last_text = cached[3:]
+    else:
+        files: dict[str, None] = {}
+        commands: list[str] = []
+        urls: list[str] = []
+        for tc in tool_calls:
+            fn = tc.get("function", {}) if isinstance(tc, dict) else {}
+            _extract_tool_facts(
+                fn.get("name", ""), fn.get("arguments", ""),
+                files, commands, urls,
+            )
+        last_text = _head_stripped(content, 200)
+        with _CACHE_LOCK:
+            _FACTS_CACHE[id(m)] = ("assistant", content, tool_calls, files, commands, urls, last_text)
+
+    state["files"].update(files)
+    state["commands"].extend(commands)
+    state["urls"].extend(urls)
+    if last_text:
+        state["last_assistant"] = last_text
+
+
+def _summary_on_tool(m: dict, state: dict) -> None:
+    content = m.get("content")
+
+    cached = _FACTS_CACHE.get(id(m))
+    if cached is not None and cached[0] == "tool" and cached[1] is content:
+        errors = cached[2]
+    else:
+        errors: list[str] = []
+        _extract_tool_errors(m, errors)
+        with _CACHE_LOCK:
+            _FACTS_CACHE[id(m)] = ("tool", content, errors)
+
+    state["errors"].extend(errors)
+
+
+_SUMMARY_HANDLERS = {
+    "user": _summary_on_user,
+    "assistant": _summary_on_assistant,
+    "tool": _summary_on_tool,
+}
+
+
 def _extract_tool_errors(msg: dict, errors: list[str]) -> None:
     """Extract error info from a tool-result message."""
     content = msg.get("content", "")
+    # Substring screen: most tool results succeed, and a successful
+    # result can never contain `"success": false` at the top level —
+    # skip the full parse on that path and only deserialize candidates.
+    if isinstance(content, str) and not _FAIL_JSON_RE.search(content):
+        return
     try:
         data = json.loads(content) if isinstance(content, str) else content
     except (json.JSONDecodeError, TypeError):
@@ -6,10 +6,15 @@ and streams progress back via a callback.
 v2: Integrated dynamic prompts, smart context, task classifier, adaptive escalation.
 """
 import json
+import re
 import time
+import random
 import asyncio
-import traceback
-from typing import Callable, Awaitable, Optional, List
+import orjson
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import accumulate, islice
+from typing import Callable, Awaitable, NamedTuple, Optional, List
 from dataclasses import dataclass, field
 
 from config import settings
@@ -23,17 +28,23 @@ from docker_manager.manager import docker_manager
 from agents.prompts import get_prompt, PromptConfig
 from agents.classifier import classify_task, should_use_parallel_plan
 from agents.context import (
-    compress_tool_result,
+    compress_tool_result_dict,
     build_context_summary,
     estimate_tokens,
     compress_recent_messages,
+    _message_chars,
 )
 from agents.escalation import EscalationState, make_args_hash
 
 
-@dataclass
+@dataclass(slots=True)
 class AgentStep:
-    """A single step in the agent's execution."""
+    """A single step in the agent's execution.
+
+    slots=True: hundreds of these are created per session (every thinking /
+    tool_call / tool_result / response), so dropping per-instance __dict__
+    roughly halves their memory and speeds up attribute reads in to_dict().
+    """
     step_number: int
     type: str  # "thinking", "tool_call", "tool_result", "response"
     content: str
@@ -54,6 +65,56 @@ class AgentStep:
         }
 
 
+class _StepFlusher:
+    """Coalesces on_step emissions into micro-batches.
+
+    The UI renders at ~60 fps, so steps landing within the same frame
+    (tool_call + tool_result pairs during bursty execution) don't need a
+    websocket round-trip each: they are buffered and delivered together
+    once 4 pile up or ~16 ms pass since the last flush. Delivery is still
+    one on_step await per step, in order — the websocket layer and the
+    frontend keep their per-step contract.
+    """
+
+    __slots__ = ("_on_step", "_pending", "_last_flush", "_flush_task")
+
+    MAX_PENDING = 4
+    MAX_AGE = 0.016  # one 60fps frame
+
+    def __init__(self, on_step: Callable[["AgentStep"], Awaitable[None]]):
+        self._on_step = on_step
+        self._pending: list[AgentStep] = []
+        self._last_flush = time.monotonic()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def __call__(self, step: "AgentStep"):
+        self._pending.append(step)
+        if (len(self._pending) >= self.MAX_PENDING
+                or time.monotonic() - self._last_flush > self.MAX_AGE):
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            # A step emitted right before a long await (tool execution)
+            # would otherwise sit buffered until the next emission; the
+            # timer guarantees delivery within ~MAX_AGE regardless.
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.MAX_AGE)
+        await self.flush()
+
+    async def flush(self):
+        task = self._flush_task
+        if task is not None and task is not asyncio.current_task() and not task.done():
+            task.cancel()
+            self._flush_task = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._last_flush = time.monotonic()
+        for step in pending:
+            await self._on_step(step)
+
+
 # Plan file in the project — the model creates it and follows it
 AGENT_PLAN_FILE = ".agent_plan.md"
 
@@ -63,6 +124,183 @@ CONTEXT_SUMMARY_THRESHOLD = 20  # reduced from 30
 MAX_CONTEXT_TOKENS = 12_000     # token budget for recent messages
 MAX_TOTAL_CONTEXT_TOKENS = 48_000  # hard cap before sending to LLM (most models support 64-128k)
 
+# Settings snapshot — getattr with a default walks the descriptor chain on
+# every call, and these are read inside the agent loop. Settings come from
+# .env at startup and never change afterwards, so bind them once here.
+LLM_TIMEOUT = getattr(settings, "LLM_REQUEST_TIMEOUT_SECONDS", 120)
+REDUCED_MAX_TOKENS = getattr(settings, "AGENT_REDUCED_MAX_TOKENS", True)
+CURRENT_GOAL_IN_CONTEXT = getattr(settings, "AGENT_CURRENT_GOAL_IN_CONTEXT", True)
+USE_STREAMING = getattr(settings, "AGENT_USE_STREAMING", True)
+ITERATION_EXTENSION = max(0, int(getattr(settings, "AGENT_ITERATION_EXTENSION", 0) or 0))
+DEBUG = getattr(settings, "DEBUG", True)
+
+# Tool results whose string payload exceeds this are compressed in a
+# worker thread so linear scans over huge stdout/page text can't stall
+# the event loop
+_COMPRESS_OFFLOAD_CHARS = 64_000
+
+
+class ToolOutcome(NamedTuple):
+    """One executed tool call, ready to become a role='tool' message."""
+    tool_call_id: Optional[str]
+    tool_name: str
+    result: dict
+
+
+async def _noop_step(step: "AgentStep") -> None:
+    """Stands in for on_step when no callback is attached, so the run
+    loop awaits one callable unconditionally instead of branching at
+    every emission site."""
+    return None
+
+
+def _result_payload_chars(result: dict) -> int:
+    """Rough size of the string payload inside a tool result dict."""
+    r = result.get("result")
+    if not isinstance(r, dict):
+        return 0
+    return sum(len(v) for v in r.values() if isinstance(v, str))
+
+
+def _log_exception(prefix: str, exc: BaseException) -> None:
+    """Log an exception: one line in production, full traceback in DEBUG.
+
+    format_exc() walks the stack and pulls source lines through linecache,
+    which is wasted work when the log line is all anyone reads — so the
+    expensive form (and the traceback import itself) only runs in DEBUG.
+    """
+    if DEBUG:
+        import traceback
+        print(f"{prefix}\n{traceback.format_exc()}")
+    else:
+        print(f"{prefix} {type(exc).__name__}: {exc}")
+
+# ── JSON-repair patterns (compiled once at import) ────────────────
+_FILEPATH_RE = re.compile(r'"filepath"\s*:\s*"([^"]+)"')
+_CONTENT_RE = re.compile(r'"content"\s*:\s*"(.*)', re.DOTALL)
+# Trailing '"}' / '",' garbage after a (possibly truncated) value
+_CONTENT_TAIL_RE = re.compile(r'"\s*[,}].*$', re.DOTALL)
+# One {"filepath": …, "content": "… object inside write_files args
+_WRITE_FILES_RE = re.compile(
+    r'\{\s*"filepath"\s*:\s*"([^"]+)"\s*,\s*"content"\s*:\s*"'
+)
+# Escape sequences the repair path decodes; a single left-to-right pass,
+# so an escaped backslash is consumed atomically and can't be picked up
+# again by a later scan
+_ESC_RE = re.compile(r'\\([nt"\\])')
+_ESC_MAP = {"n": "\n", "t": "\t", '"': '"', "\\": "\\"}
+
+# Tools safe to run concurrently within their domain (reads plus the
+# single-file write); everything else acts as a scheduling barrier —
+# see _schedule_tool_calls
+_INDEPENDENT_TOOLS = frozenset({
+    'read_file', 'write_file', 'list_files',
+    'browser_screenshot', 'browser_get_content',
+    'browser_get_page_structure',
+    'browser_get_console_logs', 'browser_get_network_failures',
+    'browser_execute_script', 'browser_scroll',
+})
+
+
+def _unescape_json(s: str) -> str:
+    """Decode \\n / \\t / \\" / \\\\ in a broken JSON string value."""
+    return _ESC_RE.sub(lambda m: _ESC_MAP[m.group(1)], s)
+
+
+# ── Tool-result summarizers (one per tool, dispatched by name) ────
+
+def _sum_execute_command(r: dict) -> str:
+    exit_code = r.get("exit_code", -1)
+    if exit_code == 0:
+        stdout = r.get("stdout", "").strip()
+        return f"✅ Команда выполнена" + (f": {stdout[:200]}" if stdout else "")
+    stderr = r.get("stderr", "").strip()
+    return f"⚠️ Код выхода {exit_code}: {stderr[:200]}"
+
+
+def _sum_write_file(r: dict) -> str:
+    return f"✅ Файл создан: {r.get('filepath', '?')}"
+
+
+def _sum_write_files(r: dict) -> str:
+    written = r.get("written", [])
+    errs = r.get("errors")
+    if errs:
+        return f"✅ Записано файлов: {len(written)}, ошибок: {len(errs)}"
+    return f"✅ Записано файлов: {len(written)}"
+
+
+def _sum_read_file(r: dict) -> str:
+    content = r.get("content", "")
+    # count('\n') + 1 == len(split('\n')) without building the list
+    lines = content.count("\n") + 1
+    return f"📄 Прочитан файл: {r.get('filepath', '?')} ({lines} строк)"
+
+
+def _sum_list_files(r: dict) -> str:
+    files = r.get("files", [])
+    return f"📁 Найдено {len(files)} файлов в {r.get('path', '?')}"
+
+
+def _sum_page_structure(r: dict) -> str:
+    el = r.get("elements", [])
+    return f"✅ На странице {len(el)} элементов (inputs/buttons). Используй их selector для type и click."
+
+
+def _sum_select(r: dict) -> str:
+    return f"✅ Выбрана опция: {r.get('selector', '?')}"
+
+
+def _sum_fill_form(r: dict) -> str:
+    return f"✅ Форма заполнена: {r.get('filled', 0)} полей, URL: {r.get('url', '')[:50]}"
+
+
+def _sum_screenshot(r: dict) -> str:
+    pt = r.get("page_text", "")
+    if len(pt) > 150:
+        return f"✅ Скриншот сохранён. Текст страницы: {pt[:150]}..."
+    return f"✅ Скриншот сохранён. Текст страницы: {pt or '(пусто)'}"
+
+
+def _sum_console_logs(r: dict) -> str:
+    logs = r.get("logs", [])
+    if logs:
+        return f"✅ Консоль: {len(logs)} записей. Используй для поиска JS-ошибок."
+    return "✅ Консоль: записей нет."
+
+
+def _sum_network_failures(r: dict) -> str:
+    fails = r.get("request_failures", [])
+    bad = r.get("bad_status_responses", [])
+    return f"✅ Сеть: {len(fails)} сбоев запросов, {len(bad)} ответов 4xx/5xx."
+
+
+def _sum_execute_script(r: dict) -> str:
+    script_result = r.get('result')
+    preview = str(script_result if script_result is not None else 'ok')
+    return f"✅ Скрипт выполнен: {preview[:80]}"
+
+
+def _sum_scroll(r: dict) -> str:
+    return f"✅ Страница прокручена: {r.get('scrolled', 'ok')}"
+
+
+_SUMMARIZERS = {
+    "execute_command":              _sum_execute_command,
+    "write_file":                   _sum_write_file,
+    "write_files":                  _sum_write_files,
+    "read_file":                    _sum_read_file,
+    "list_files":                   _sum_list_files,
+    "browser_get_page_structure":   _sum_page_structure,
+    "browser_select":               _sum_select,
+    "browser_fill_form":            _sum_fill_form,
+    "browser_screenshot":           _sum_screenshot,
+    "browser_get_console_logs":     _sum_console_logs,
+    "browser_get_network_failures": _sum_network_failures,
+    "browser_execute_script":       _sum_execute_script,
+    "browser_scroll":               _sum_scroll,
+}
+
 
 class AgentEngine:
     """
@@ -71,14 +309,12 @@ class AgentEngine:
 
     MAX_ITERATIONS = settings.AGENT_MAX_ITERATIONS  # Safety limit (configurable)
 
-    # Class-level regex patterns cache (lazy initialization)
-    _filepath_regex = None
-    _content_regex = None
-
     def __init__(self, project_id: str, use_multi_agent: bool = False):
         self.project_id = project_id
-        self.tool_executor = ToolExecutor(project_id)
-        self.steps: list[AgentStep] = []
+        self.tool_executor = ToolExecutor.get(project_id)
+        # Bounded: old steps are already streamed to the UI, so a runaway
+        # session can't grow this without limit.
+        self.steps: deque[AgentStep] = deque(maxlen=10_000)
         # System message will be set dynamically based on task class
         self.messages: list[dict] = [
             {"role": "system", "content": ""}
@@ -94,10 +330,65 @@ class AgentEngine:
         self._prompt_cfg: PromptConfig = get_prompt("coding")
         self.escalation = EscalationState()
 
+        # Memo for build_context_summary: the old part of the history only
+        # changes when the split boundary moves, but _get_messages_for_llm
+        # runs every loop iteration. Keyed by (length, id of last message) —
+        # the history is append-only between trims, so an identical tail
+        # object at the same length means an identical prefix.
+        self._summary_cache: dict[tuple[int, int], str] = {}
+        # Background summary pre-compute kicked off after a final answer,
+        # so the next turn's context build doesn't wait on it
+        self._summary_task: Optional[asyncio.Task] = None
+
+        # Sorted absolute indices of "user" messages: turns safe-split and
+        # last-user lookups into bisect queries instead of linear walks.
+        # Kept in sync by _append; rebuilt lazily when the history list is
+        # replaced wholesale (length drift is the tell).
+        self._user_indices: list[int] = []
+        self._user_sync_len: int = 1
+
+        # The history only ever gets invalid (orphan tool chains) on a few
+        # paths: the 50-message trimmer, and a stop/exception landing between
+        # an assistant's tool_calls and its tool results. Those set this
+        # flag; while it's clean, _get_messages_for_llm skips the validation
+        # pass on the short-history branch.
+        self._messages_dirty = False
+
+        # Incremental context cache: the validated/compressed output of the
+        # last full _get_messages_for_llm build plus how much of
+        # self.messages it covered. While the history only grows by
+        # appended complete chains, the next build is cache + delta instead
+        # of a full re-split. Epoch bumps on any non-append mutation
+        # (trim, system-message rewrite) and kills the cache.
+        self._cached_llm_messages: Optional[list[dict]] = None
+        self._cached_base_len = 0
+        # History length at the last FULL rebuild: the drift bound is
+        # measured against this anchor, not against _cached_base_len,
+        # which moves forward on every incremental extension.
+        self._cached_full_build_len = 0
+        self._cached_epoch = -1
+        self._messages_epoch = 0
+
     def stop(self):
         """Request agent to stop execution."""
         self._stop_requested = True
 
+    def _sync_user_indices(self) -> None:
+        """Rebuild the user-index cache if the history changed outside _append."""
+        if self._user_sync_len != len(self.messages):
+            self._user_indices = [
+                i for i, m in enumerate(self.messages) if m.get("role") == "user"
+            ]
+            self._user_sync_len = len(self.messages)
+
+    def _append(self, m: dict) -> None:
+        """Append to the history, keeping the user-index cache in sync."""
+        self._sync_user_indices()
+        self.messages.append(m)
+        if m.get("role") == "user":
+            self._user_indices.append(len(self.messages) - 1)
+        self._user_sync_len = len(self.messages)
+
     def _get_filtered_tools(self) -> list[dict]:
         """Get tools filtered by current prompt config."""
         if self._prompt_cfg.tool_filter is None:
@@ -107,35 +398,29 @@ class AgentEngine:
             if t["function"]["name"] in self._prompt_cfg.tool_filter
         ]
 
-    @staticmethod
-    def _find_safe_split(rest: list[dict], target_n: int) -> int:
+    def _find_safe_split(self, rest: list[dict], target_n: int, offset: int = 1) -> int:
         """
         Find the index in `rest` where it's safe to split into [old, recent].
 
         The split must NOT land inside an assistant(tool_calls) → tool → tool chain.
         Safe boundaries: 'user' message, or 'assistant' WITHOUT tool_calls.
-        We start at the desired position and walk BACKWARD to find the nearest
-        safe boundary (a 'user' message).  This guarantees recent never starts
-        with orphaned 'tool' messages.
-        """
-        split = max(0, len(rest) - target_n)
+        The nearest 'user' message at or before the desired position wins
+        (falling forward to the first 'user' overall when there is none) —
+        this guarantees recent never starts with orphaned 'tool' messages.
 
-        # Walk backward to find a safe start (a 'user' message)
-        while split > 0:
-            role = rest[split].get("role")
-            if role == "user":
-                break
-            split -= 1
-
-        # If we hit the start without finding a user message, walk forward instead
-        if split == 0 and rest[0].get("role") != "user":
-            split = 0
-            while split < len(rest):
-                if rest[split].get("role") == "user":
-                    break
-                split += 1
-
-        return split
+        `rest` is self.messages[offset:]; the query runs against the
+        maintained user-index cache, so it's two bisects instead of a walk.
+        """
+        self._sync_user_indices()
+        desired = max(0, len(rest) - target_n) + offset
+        ui = self._user_indices
+        lo = bisect_left(ui, offset)     # ignore anything before `rest` starts
+        hi = bisect_right(ui, desired)
+        if hi > lo:
+            return ui[hi - 1] - offset   # nearest user at or before desired
+        if lo < len(ui):
+            return ui[lo] - offset       # no user before → first user after
+        return len(rest)                 # no user messages at all
 
     @staticmethod
     def _validate_messages(messages: list[dict]) -> list[dict]:
@@ -150,9 +435,13 @@ class AgentEngine:
         to prevent 400 invalid_request_error responses.
         """
         result: list[dict] = []
+        append = result.append
+        n = len(messages)
         i = 0
 
-        while i < len(messages):
+        # Single forward pass: each message is visited exactly once (a tool
+        # run consumed by a chain check is skipped via `i = j`, not re-read).
+        while i < n:
             m = messages[i]
             role = m.get("role")
 
@@ -164,52 +453,58 @@ class AgentEngine:
                 continue
 
             # Handle assistant tool_calls chains
-            if role == "assistant" and m.get("tool_calls"):
-                tc_ids: list[str] = []
-                for tc in (m.get("tool_calls") or []):
-                    if isinstance(tc, dict) and tc.get("id"):
-                        tc_ids.append(tc["id"])
-
-                # Look ahead: collect consecutive tool messages after this assistant
-                seen: set[str] = set()
-                j = i + 1
-                while j < len(messages) and messages[j].get("role") == "tool":
-                    tid = messages[j].get("tool_call_id")
-                    if tid in tc_ids:
-                        seen.add(tid)
-                    j += 1
+            if role == "assistant":
+                tool_calls = m.get("tool_calls")
+                if tool_calls:
+                    tc_ids: list[str] = [
+                        tc["id"] for tc in tool_calls
+                        if isinstance(tc, dict) and tc.get("id")
+                    ]
+                    wanted = set(tc_ids)
+
+                    # Look ahead: collect consecutive tool messages after this assistant
+                    seen: set[str] = set()
+                    j = i + 1
+                    while j < n and messages[j].get("role") == "tool":
+                        tid = messages[j].get("tool_call_id")
+                        if tid in wanted:
+                            seen.add(tid)
+                        j += 1
+
+                    # If chain is complete → keep assistant + its tool messages
+                    if tc_ids and seen == wanted:
+                        append(m)
+                        result.extend(islice(messages, i + 1, j))
+                        i = j
+                        continue
 
-                # If chain is complete → keep assistant + its tool messages
-                if tc_ids and seen == set(tc_ids):
-                    result.append(m)
-                    result.extend(messages[i + 1 : j])
-                    i = j
-                    continue
+                    # Chain is incomplete → make message API-safe
+                    print(f"⚠️ [Agent] Dropping incomplete tool_calls chain: expected={tc_ids}, seen={sorted(seen)}")
+                    safe = dict(m)
+                    safe.pop("tool_calls", None)
 
-                # Chain is incomplete → make message API-safe
-                print(f"⚠️ [Agent] Dropping incomplete tool_calls chain: expected={tc_ids}, seen={sorted(seen)}")
-                safe = dict(m)
-                safe.pop("tool_calls", None)
+                    # If assistant had no actual text, drop it completely
+                    if not (safe.get("content") or "").strip():
+                        i += 1
+                        continue
 
-                # If assistant had no actual text, drop it completely
-                if not (safe.get("content") or "").strip():
+                    append(safe)
                     i += 1
                     continue
 
-                result.append(safe)
-                i += 1
-                continue
-
             # Normal message
-            result.append(m)
+            append(m)
             i += 1
 
         return result
 
-    def _get_messages_for_llm(self) -> list[dict]:
+    async def _get_messages_for_llm(self) -> list[dict]:
         """
         Messages for LLM: with long history — compressed summary of old messages
         + last N recent messages (preserving full tool_call_id chains).
+
+        Async so the summary rebuild (the one CPU-heavy part, on a cache
+        miss) can run off the event loop without stalling other sessions.
         """
         messages = self.messages
         if not messages:
@@ -218,10 +513,40 @@ class AgentEngine:
         rest = messages[1:] if system_msg else messages[:]
 
         if len(rest) <= CONTEXT_SUMMARY_THRESHOLD:
+            # Known-clean short history → nothing to validate
+            if not self._messages_dirty:
+                return messages
             return self._validate_messages(messages)
 
+        # Incremental fast path: since the last full build the history only
+        # grew by appended messages → reuse the built prefix and extend it
+        # with the new tail instead of re-splitting and re-summarizing.
+        # Bounded drift: once enough new messages pile up that a fresh
+        # split would move the summary boundary anyway, rebuild fully.
+        # Measured from the last full rebuild — extending the cache must
+        # not push the anchor forward, or the boundary never moves.
+        cached = self._cached_llm_messages
+        if (cached is not None
+                and self._cached_epoch == self._messages_epoch
+                and self._cached_base_len <= len(messages)
+                and (len(messages) - self._cached_full_build_len
+                     <= CONTEXT_SUMMARY_THRESHOLD - LAST_N_MESSAGES_FULL)):
+            delta = messages[self._cached_base_len:]
+            checked = self._validate_messages(delta)
+            # Only take the shortcut when the delta is self-contained
+            # (complete tool chains, nothing dropped or rewritten)
+            if len(checked) == len(delta) and all(
+                    a is b for a, b in zip(checked, delta)):
+                result = cached + delta
+                if estimate_tokens(result) <= MAX_TOTAL_CONTEXT_TOKENS:
+                    self._cached_llm_messages = result
+                    self._cached_base_len = len(messages)
+                    return result
+
         # Find safe split point that doesn't break tool_call chains
-        split = self._find_safe_split(rest, LAST_N_MESSAGES_FULL)
+        split = self._find_safe_split(
+            rest, LAST_N_MESSAGES_FULL, offset=1 if system_msg else 0,
+        )
         old_part = rest[:split]
         recent = rest[split:]
 
@@ -229,12 +554,31 @@ class AgentEngine:
         if not recent:
             return self._validate_messages(messages)
 
-        # Build structured summary of old messages
-        summary_text = build_context_summary(old_part)
+        # Build structured summary of old messages (memoized: identical
+        # old_part → reuse the text instead of re-summarizing per iteration)
+        summary_key = (len(old_part), id(old_part[-1]))
+        summary_text = self._summary_cache.get(summary_key)
+        if summary_text is None and self._summary_task is not None:
+            # A background pre-compute may be about to land exactly this key
+            task, self._summary_task = self._summary_task, None
+            try:
+                await task
+            except Exception:
+                pass
+            summary_text = self._summary_cache.get(summary_key)
+        if summary_text is None:
+            # Off the event loop: with many concurrent agents a long-history
+            # summary rebuild shouldn't stall everyone else's turn.
+            # estimate_tokens stays inline — it's cached integer char math,
+            # cheaper than a thread hop.
+            summary_text = await asyncio.to_thread(build_context_summary, old_part)
+            if len(self._summary_cache) > 8:
+                self._summary_cache.clear()
+            self._summary_cache[summary_key] = summary_text
 
         # Find current goal in recent messages
         goal_prefix = ""
-        if getattr(settings, "AGENT_CURRENT_GOAL_IN_CONTEXT", True):
+        if CURRENT_GOAL_IN_CONTEXT:
             for m in recent:
                 if m.get("role") == "user":
                     goal = (m.get("content") or "").strip()[:300]
@@ -244,7 +588,11 @@ class AgentEngine:
 
         summary_content = f"{goal_prefix}[Контекст (сжато)]:\n{summary_text}"
 
-        # If recent part is still too large, compress tool results in it
+        # If recent part is still too large, compress tool results in it.
+        # estimate_tokens is already the cheap filter here: cached integer
+        # char math (O(new messages) via the id-keyed count cache), not a
+        # tokenizer — so it gates the expensive compression/trim work
+        # directly and needs no coarser pre-check in front of it.
         if estimate_tokens(recent) > MAX_CONTEXT_TOKENS:
             recent = compress_recent_messages(recent)
 
@@ -263,28 +611,106 @@ class AgentEngine:
             # Keep system (idx 0) + summary (idx 1) + trim from idx 2
             header = out[:2]
             tail = out[2:]
-            while tail and estimate_tokens(header + tail) > MAX_TOTAL_CONTEXT_TOKENS:
-                dropped = tail.pop(0)
-                # If we dropped an assistant with tool_calls, also drop following tool msgs
-                if dropped.get("role") == "assistant" and dropped.get("tool_calls"):
-                    while tail and tail[0].get("role") == "tool":
-                        tail.pop(0)
+            # Group the tail into droppable units: an assistant carrying
+            # tool_calls owns its consecutive tool results, so a cut can
+            # never strand orphan tool messages.
+            units: list[tuple[int, int]] = []  # (start index in tail, chars)
+            i = 0
+            n = len(tail)
+            while i < n:
+                j = i + 1
+                if tail[i].get("role") == "assistant" and tail[i].get("tool_calls"):
+                    while j < n and tail[j].get("role") == "tool":
+                        j += 1
+                units.append((i, sum(_message_chars(m) for m in tail[i:j])))
+                i = j
+            # estimate_tokens is chars * 2 // 5, so the token cap converts
+            # to an exact char budget; one bisect over the prefix sums
+            # replaces the old re-estimate-per-pop loop (O(N²) → O(log N)).
+            budget_chars = (5 * MAX_TOTAL_CONTEXT_TOKENS + 4) // 2
+            kept_chars = sum(_message_chars(m) for m in header)
+            prefix = list(accumulate(chars for _, chars in units))
+            excess = kept_chars + (prefix[-1] if prefix else 0) - budget_chars
+            # prefix[d] = chars freed by dropping units 0..d → drop d+1 units
+            drop = bisect_left(prefix, excess) + 1
+            if drop >= len(units):
+                tail = []
+            else:
+                tail = tail[units[drop][0]:]
             out = header + tail
 
+        self._cached_llm_messages = out
+        self._cached_base_len = len(messages)
+        self._cached_full_build_len = len(messages)
+        self._cached_epoch = self._messages_epoch
         return out
 
-    async def _inject_plan_into_system(self) -> None:
-        """If .agent_plan.md exists in the project, append it to system message."""
-        if not self.messages or self.messages[0].get("role") != "system":
+    def _precompute_summary_for_next_turn(self) -> None:
+        """Pre-summarize the old history in the background after a final
+        answer, so the next turn's context build finds it in the cache
+        instead of waiting on build_context_summary.
+
+        The split is computed for len(rest) + 1: the next run() starts by
+        appending one user message, which shifts the desired boundary by
+        one but (being at the very tail) can never *be* the split point.
+
+        Cache safety: build_context_summary runs in a worker thread here
+        while the current turn may still be estimating/summarizing — the
+        shared caches in agents.context are lock-guarded for exactly this
+        overlap. Still, one in-flight precompute is enough: a second one
+        would just burn a thread re-parsing the same history.
+        """
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        messages = self.messages
+        if not messages:
+            return
+        system_msg = messages[0].get("role") == "system"
+        rest = messages[1:] if system_msg else messages[:]
+        if len(rest) + 1 <= CONTEXT_SUMMARY_THRESHOLD:
             return
+
+        split = self._find_safe_split(
+            rest, LAST_N_MESSAGES_FULL - 1, offset=1 if system_msg else 0,
+        )
+        if split <= 0 or split >= len(rest):
+            return
+        old_part = rest[:split]
+        key = (len(old_part), id(old_part[-1]))
+        if key in self._summary_cache:
+            return
+
+        async def _bg():
+            text = await asyncio.to_thread(build_context_summary, old_part)
+            if len(self._summary_cache) > 8:
+                self._summary_cache.clear()
+            self._summary_cache[key] = text
+
+        self._summary_task = asyncio.create_task(_bg())
+
+    async def _read_plan_file(self) -> str:
+        """Read .agent_plan.md from the sandbox ('' when absent or empty)."""
         try:
             content = await docker_manager.read_file(
                 self.project_id,
                 f"/workspace/{AGENT_PLAN_FILE}",
             )
         except Exception:
+            return ""
+        return (content or "").strip()
+
+    async def _inject_plan_into_system(self, plan_fut: Optional[asyncio.Task] = None) -> None:
+        """If .agent_plan.md exists in the project, append it to system message.
+
+        `plan_fut` lets run() start the sandbox read early and fold the
+        result in here, right before the first LLM call needs it.
+        """
+        if not self.messages or self.messages[0].get("role") != "system":
             return
-        content = (content or "").strip()
+        if plan_fut is not None:
+            content = await plan_fut
+        else:
+            content = await self._read_plan_file()
         if not content:
             return
         plan_block = f"\n\nТекущий план (файл {AGENT_PLAN_FILE}):\n---\n{content[:4000]}\n---"
@@ -292,15 +718,7 @@ class AgentEngine:
             "role": "system",
             "content": (self.messages[0].get("content") or "") + plan_block,
         }
-
-    @classmethod
-    def _get_regex_patterns(cls):
-        """Get or compile regex patterns for JSON repair (lazy initialization)."""
-        if cls._filepath_regex is None:
-            import re
-            cls._filepath_regex = re.compile(r'"filepath"\s*:\s*"([^"]+)"')
-            cls._content_regex = re.compile(r'"content"\s*:\s*"(.*)', re.DOTALL)
-        return cls._filepath_regex, cls._content_regex
+        self._messages_epoch += 1
 
     async def run(
         self,
@@ -342,6 +760,7 @@ class AgentEngine:
 
         # ── 2. Set up system prompt ───────────────────────────────
         self.messages[0] = {"role": "system", "content": self._prompt_cfg.system}
+        self._messages_epoch += 1
 
         # Reset state
         self._stop_requested = False
@@ -349,7 +768,11 @@ class AgentEngine:
             current_provider=llm_router.get_provider(task_type).name,
         )
 
-        self.messages.append({"role": "user", "content": user_message})
+        self._append({"role": "user", "content": user_message})
+
+        # Start the plan-file read now: it's sandbox I/O independent of the
+        # trimming below, and the simple-chat path never needs it at all.
+        plan_fut = asyncio.create_task(self._read_plan_file())
 
         # ── 3. Trim history (keep tool_call chains intact) ────────
         MAX_MESSAGES = 50
@@ -368,24 +791,43 @@ class AgentEngine:
                     j += 1
                 rest = rest[:i] + rest[j:]
             self.messages = ([system_msg] + rest) if system_msg else rest
-
-        # ── 4. Inject plan file into system message ───────────────
-        await self._inject_plan_into_system()
+            # Dropped messages may be freed and their ids reused — don't let
+            # a stale summary match a recycled (len, id) key. A background
+            # pre-compute in flight would write a stale key too — cancel it.
+            if self._summary_task is not None:
+                self._summary_task.cancel()
+                self._summary_task = None
+            self._summary_cache.clear()
+            # Force a user-index rebuild even if the trim was length-neutral
+            self._user_sync_len = -1
+            # The cut may have stranded part of a tool_call chain
+            self._messages_dirty = True
+            self._messages_epoch += 1
 
         step_num = 0
 
-        # ── 5. Fast path: simple_chat (no tools) ─────────────────
+        # ── 4. Fast path: simple_chat (no tools) ─────────────────
+        # Replies straight away without waiting for the plan-file read —
+        # the fast path builds its own system message without the plan.
         if self._task_class == "simple_chat":
             try:
-                return await self._run_simple_chat(
+                result = await self._run_simple_chat(
                     user_message, on_step, on_stream_chunk, images,
                 )
+                plan_fut.cancel()
+                return result
             except Exception as e:
-                print(f"⚠️ [Agent] Fast path failed, falling back to full loop:\n{traceback.format_exc()}")
+                _log_exception("⚠️ [Agent] Fast path failed, falling back to full loop:", e)
                 # Fall through to full loop
                 self._task_class = "coding"
                 self._prompt_cfg = get_prompt("coding")
                 self.messages[0] = {"role": "system", "content": self._prompt_cfg.system}
+                self._messages_epoch += 1
+
+        # ── 5. Inject plan file into system message ───────────────
+        # The read has been running since before the trim; awaiting it here
+        # folds it in right before the first LLM call that actually uses it.
+        await self._inject_plan_into_system(plan_fut)
 
         # ── 6. Parallel path: split into subtasks ─────────────────
         if should_use_parallel_plan(user_message, images):
@@ -403,10 +845,10 @@ class AgentEngine:
                     )
                     if on_step:
                         await on_step(AgentStep(step_num + 2, "response", result))
-                    self.messages.append({"role": "assistant", "content": result})
+                    self._append({"role": "assistant", "content": result})
                     return result
             except Exception as e:
-                print(f"⚠️ [Agent] Parallel plan failed, falling back to single agent:\n{traceback.format_exc()}")
+                _log_exception("⚠️ [Agent] Parallel plan failed, falling back to single agent:", e)
 
         # ── 7. Main agent loop ────────────────────────────────────
         return await self._run_loop(0, on_step, task_type, images, self.MAX_ITERATIONS, None)
@@ -419,30 +861,28 @@ class AgentEngine:
         images: Optional[list[dict]],
     ) -> str:
         """Fast path: one LLM call without tools for simple chat messages."""
-        # Build chat-only message history (no tool_calls) for context
-        def to_chat_msg(m):
-            r = m.get("role")
-            if r == "user":
-                return {"role": "user", "content": (m.get("content") or "").strip()}
-            if r == "assistant" and "tool_calls" not in m:
+        # Build chat-only message history (no tool_calls) for context.
+        # Walk backward and stop once 12 messages are collected — a long
+        # session shouldn't be scanned in full just to keep the last dozen.
+        recent: list[dict] = []
+        for m in reversed(self.messages):
+            role = m.get("role")
+            if role == "user":
+                recent.append({"role": "user", "content": (m.get("content") or "").strip()})
+            elif role == "assistant" and "tool_calls" not in m:
                 c = (m.get("content") or "").strip()
                 if c:
-                    return {"role": "assistant", "content": c}
-            return None
-
-        chat_only = [to_chat_msg(m) for m in self.messages]
-        chat_only = [m for m in chat_only if m is not None]
-        recent = chat_only[-12:] if len(chat_only) > 12 else chat_only
+                    recent.append({"role": "assistant", "content": c})
+            if len(recent) == 12:
+                break
+        recent.reverse()
 
         fast_messages = [
             {"role": "system", "content": self._prompt_cfg.system},
         ] + recent
 
         cfg = self._prompt_cfg
-        use_streaming = (
-            getattr(settings, "AGENT_USE_STREAMING", True)
-            and on_stream_chunk is not None
-        )
+        use_streaming = USE_STREAMING and on_stream_chunk is not None
 
         if use_streaming:
             final_text = ""
@@ -469,7 +909,7 @@ class AgentEngine:
             choice = response.choices[0]
             final_text = (choice.message.content or "").strip() or "Привет!"
 
-        self.messages.append({"role": "assistant", "content": final_text})
+        self._append({"role": "assistant", "content": final_text})
         if on_step:
             await on_step(AgentStep(1, "response", final_text))
         print(f"⚡ [Agent] Fast reply ({self._task_class}): {final_text[:50]}...")
@@ -495,12 +935,45 @@ class AgentEngine:
             if self._stop_requested:
                 return "Выполнение остановлено пользователем"
 
-            async def run_one(subtask: dict):
+            engines = []
+            for subtask in wave:
                 engine = AgentEngine(self.project_id)
                 engine.messages = [
                     {"role": "system", "content": coding_prompt.system},
                     {"role": "user", "content": subtask["description"]},
                 ]
+                engines.append(engine)
+
+            # First turn of a parallel wave goes out as one batched call:
+            # every subtask shares the same system prefix, so one provider
+            # serves all the prefills and its prefix cache actually hits.
+            # On timeout/failure the slot stays None and that engine simply
+            # makes its own first call inside _run_loop.
+            first_responses = [None] * len(wave)
+            if len(wave) > 1:
+                max_tokens_first = coding_prompt.max_tokens
+                if REDUCED_MAX_TOKENS and max_tokens_first > 2048:
+                    max_tokens_first = 2048
+                try:
+                    first_responses = await asyncio.wait_for(
+                        llm_router.chat_batch(
+                            [e.messages for e in engines],
+                            task_type=task_type,
+                            tools=engines[0]._get_filtered_tools(),
+                            temperature=coding_prompt.temperature,
+                            max_tokens=max_tokens_first,
+                            images=images,
+                        ),
+                        timeout=LLM_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    print(f"⏱️ [Agent] Batch first-turn timeout ({LLM_TIMEOUT}s), волна {wave_idx + 1}")
+                    first_responses = [None] * len(wave)
+                first_responses = [
+                    None if isinstance(r, Exception) else r for r in first_responses
+                ]
+
+            async def run_one(subtask: dict, engine: "AgentEngine", first_response=None):
                 step_prefix = f"[{subtask['id']}] "
 
                 async def wrapped_on_step(s: AgentStep):
@@ -514,15 +987,19 @@ class AgentEngine:
                     0, wrapped_on_step, task_type, images,
                     max_iterations=settings.AGENT_SUBTASK_MAX_ITERATIONS,
                     stop_ref=lambda: self._stop_requested,
+                    first_response=first_response,
                 )
 
             if len(wave) == 1:
-                res = await run_one(wave[0])
+                res = await run_one(wave[0], engines[0])
                 result_by_id[wave[0]["id"]] = res
                 all_results.append(res)
             else:
                 print(f"⚡ [Agent] Параллельное выполнение {len(wave)} подзадач (волна {wave_idx + 1})")
-                results = await asyncio.gather(*[run_one(st) for st in wave], return_exceptions=True)
+                results = await asyncio.gather(
+                    *[run_one(st, en, fr) for st, en, fr in zip(wave, engines, first_responses)],
+                    return_exceptions=True,
+                )
                 for st, res in zip(wave, results):
                     if isinstance(res, Exception):
                         err = f"Подзадача '{st.get('id', '?')}' завершилась с ошибкой: {res}"
@@ -545,12 +1022,61 @@ class AgentEngine:
         max_iterations: int,
         stop_ref: Optional[Callable[[], bool]],
         allow_auto_extend: bool = True,
+        first_response=None,
+    ) -> str:
+        """Wraps the core loop with step micro-batching (see _StepFlusher)."""
+        if on_step is None or isinstance(on_step, _StepFlusher):
+            # Already wrapped (auto-extend recursion) or nothing to emit
+            return await self._run_loop_inner(
+                step_num_start, on_step, task_type, images,
+                max_iterations, stop_ref, allow_auto_extend, first_response,
+            )
+        flusher = _StepFlusher(on_step)
+        try:
+            return await self._run_loop_inner(
+                step_num_start, flusher, task_type, images,
+                max_iterations, stop_ref, allow_auto_extend, first_response,
+            )
+        finally:
+            # Never swallow buffered steps, whatever path the loop exits by
+            await flusher.flush()
+
+    async def _run_loop_inner(
+        self,
+        step_num_start: int,
+        on_step: Optional[Callable[[AgentStep], Awaitable[None]]],
+        task_type: str,
+        images: Optional[list],
+        max_iterations: int,
+        stop_ref: Optional[Callable[[], bool]],
+        allow_auto_extend: bool = True,
+        first_response=None,
     ) -> str:
-        """Core agent loop: LLM + tools. Uses self.messages and self.tool_executor."""
+        """Core agent loop: LLM + tools. Uses self.messages and self.tool_executor.
+
+        first_response: precomputed LLM response for the first iteration
+        (parallel subtask waves batch their first turns into one call).
+        """
         step_num = step_num_start
+        emit = on_step if on_step is not None else _noop_step
         stop_check = stop_ref if stop_ref is not None else (lambda: self._stop_requested)
         cfg = self._prompt_cfg
         filtered_tools = self._get_filtered_tools()
+        # Loop invariants: prompt config doesn't change mid-loop, so pull
+        # the attributes out of the hottest loop in the file.
+        cfg_max_tokens = cfg.max_tokens
+        cfg_temperature = cfg.temperature
+        # Specialized routing invariants: escalation is the only event that
+        # changes these mid-loop, so they're recomputed exactly once at the
+        # mark_escalated site below instead of on every iteration.
+        if self.escalation.escalated:
+            effective_task_type = self.escalation.current_provider
+            max_tokens_loop = cfg_max_tokens
+        else:
+            effective_task_type = task_type
+            max_tokens_loop = cfg_max_tokens
+            if REDUCED_MAX_TOKENS and max_tokens_loop > 2048:
+                max_tokens_loop = 2048
 
         for iteration in range(max_iterations):
             if stop_check():
@@ -559,8 +1085,7 @@ class AgentEngine:
                     type="response",
                     content="⏹️ Выполнение остановлено пользователем",
                 )
-                if on_step:
-                    await on_step(stop_step)
+                await emit(stop_step)
                 return "Выполнение остановлено пользователем"
 
             step_num += 1
@@ -573,9 +1098,8 @@ class AgentEngine:
                 )
                 print(f"🔒 [Agent] Stuck detected at iteration {iteration + 1}")
                 stuck_step = AgentStep(step_number=step_num, type="response", content=stuck_msg)
-                if on_step:
-                    await on_step(stuck_step)
-                self.messages.append({"role": "assistant", "content": stuck_msg})
+                await emit(stuck_step)
+                self._append({"role": "assistant", "content": stuck_msg})
                 return stuck_msg
 
             # Warn when approaching limit
@@ -586,8 +1110,7 @@ class AgentEngine:
                     type="thinking",
                     content=f"⚠️ Осталось {remaining} итераций. Завершаю задачу...",
                 )
-                if on_step:
-                    await on_step(warning_step)
+                await emit(warning_step)
 
             # ── Escalation check ──────────────────────────────────
             if self.escalation.should_escalate():
@@ -595,96 +1118,105 @@ class AgentEngine:
                 hint = self.escalation.get_escalation_hint()
                 self.escalation.mark_escalated(target)
 
-                if on_step:
-                    await on_step(AgentStep(
+                await emit(AgentStep(
                         step_num, "thinking",
                         f"🔄 Переключаюсь на модель '{target}' для лучшего результата...",
                     ))
 
                 # Inject hint so the new model re-analyzes the problem
-                self.messages.append({"role": "user", "content": hint})
+                self._append({"role": "user", "content": hint})
                 print(f"🔄 [Agent] Escalated: {self.escalation.current_provider} → {target}")
 
-            # Thinking step for UI
+                # Re-specialize: route to the escalation target with the
+                # prompt's full token budget (reduced cap no longer applies)
+                effective_task_type = target
+                max_tokens_loop = cfg_max_tokens
+
+            # Thinking step for UI. Last user content comes from the
+            # maintained user index instead of an O(N) backward scan.
+            self._sync_user_indices()
             last_user_content = ""
-            for m in reversed(self.messages):
-                if m.get("role") == "user" and m.get("content"):
-                    raw = (m.get("content") or "").strip()
+            for idx in reversed(self._user_indices):
+                raw = self.messages[idx].get("content")
+                if raw:
+                    raw = raw.strip()
                     last_user_content = raw[:80] + ("…" if len(raw) > 80 else "")
                     break
             n_msgs = len(self.messages)
-            thinking_content = f"Думаю... (итерация {iteration + 1}/{max_iterations})"
             if last_user_content or n_msgs > 2:
-                thinking_content += f"\nВ запросе: {n_msgs} сообщ. Последнее от вас: «{last_user_content or '—'}»"
+                thinking_content = (
+                    f"Думаю... (итерация {iteration + 1}/{max_iterations})"
+                    f"\nВ запросе: {n_msgs} сообщ. Последнее от вас: «{last_user_content or '—'}»"
+                )
+            else:
+                thinking_content = f"Думаю... (итерация {iteration + 1}/{max_iterations})"
             thinking_step = AgentStep(
                 step_number=step_num,
                 type="thinking",
                 content=thinking_content,
             )
-            if on_step:
-                await on_step(thinking_step)
+            await emit(thinking_step)
 
             print(f"🧠 [Agent] Итерация {iteration + 1}/{max_iterations}: Думаю над задачей...")
 
-            # ── LLM call (with per-request timeout and retry) ─────
-            messages_to_send = self._get_messages_for_llm()
-
-            effective_task_type = task_type
-            if self.escalation.escalated:
-                effective_task_type = self.escalation.current_provider
+            # Don't let buffered steps sit invisible through the long LLM await
+            if isinstance(on_step, _StepFlusher):
+                await on_step.flush()
 
-            max_tokens_loop = cfg.max_tokens
-            if (not self.escalation.escalated
-                    and getattr(settings, "AGENT_REDUCED_MAX_TOKENS", True)
-                    and max_tokens_loop > 2048):
-                max_tokens_loop = 2048
-
-            llm_timeout = getattr(settings, "LLM_REQUEST_TIMEOUT_SECONDS", 120)
-            max_retries = 2
-            response = None
-
-            for attempt in range(1, max_retries + 1):
-                try:
-                    print(f"📡 [Agent] LLM запрос (attempt {attempt}, task: {effective_task_type}, "
-                          f"class: {self._task_class}, msgs: {len(messages_to_send)})...")
-
-                    response = await asyncio.wait_for(
-                        llm_router.chat(
-                            messages=messages_to_send,
-                            task_type=effective_task_type,
-                            tools=filtered_tools,
-                            temperature=cfg.temperature,
-                            max_tokens=max_tokens_loop,
-                            images=images,
-                        ),
-                        timeout=llm_timeout,
-                    )
-                    print(f"✅ [Agent] Получен ответ от LLM")
-                    break
-                except asyncio.TimeoutError:
-                    print(f"⏱️ [Agent] LLM timeout ({llm_timeout}s), attempt {attempt}/{max_retries}")
-                    if attempt < max_retries:
-                        await asyncio.sleep(2 * attempt)
-                        continue
-                    error_step = AgentStep(
-                        step_number=step_num, type="error",
-                        content=f"LLM не ответил за {llm_timeout}с после {max_retries} попыток",
-                    )
-                    if on_step:
-                        await on_step(error_step)
-                    return f"LLM не ответил за {llm_timeout}с. Попробуйте повторить запрос."
-                except Exception as e:
-                    print(f"❌ [Agent] LLM error (attempt {attempt}):\n{traceback.format_exc()}")
-                    if attempt < max_retries:
-                        await asyncio.sleep(2 * attempt)
-                        continue
-                    error_step = AgentStep(
-                        step_number=step_num, type="error",
-                        content=f"Ошибка LLM: {str(e)}",
-                    )
-                    if on_step:
-                        await on_step(error_step)
-                    return f"Произошла ошибка при обращении к AI: {str(e)}"
+            # ── LLM call (with per-request timeout and retry) ─────
+            if iteration == 0 and first_response is not None:
+                # First turn was already answered by the wave's batched call
+                response = first_response
+                print(f"✅ [Agent] Первый ход получен из батч-запроса волны")
+            else:
+                messages_to_send = await self._get_messages_for_llm()
+
+                llm_timeout = LLM_TIMEOUT
+                max_retries = 2
+                response = None
+
+                for attempt in range(1, max_retries + 1):
+                    try:
+                        print(f"📡 [Agent] LLM запрос (attempt {attempt}, task: {effective_task_type}, "
+                              f"class: {self._task_class}, msgs: {len(messages_to_send)})...")
+
+                        # asyncio.timeout is lighter than wait_for (no extra
+                        # task wrapper per call) and cancels in place
+                        async with asyncio.timeout(llm_timeout):
+                            response = await llm_router.chat(
+                                messages=messages_to_send,
+                                task_type=effective_task_type,
+                                tools=filtered_tools,
+                                temperature=cfg_temperature,
+                                max_tokens=max_tokens_loop,
+                                images=images,
+                            )
+                        print(f"✅ [Agent] Получен ответ от LLM")
+                        break
+                    except asyncio.TimeoutError:
+                        print(f"⏱️ [Agent] LLM timeout ({llm_timeout}s), attempt {attempt}/{max_retries}")
+                        if attempt < max_retries:
+                            # Jittered exponential backoff so concurrent
+                            # sessions don't retry in lockstep
+                            await asyncio.sleep((2 ** attempt) * 0.5 + random.random() * 0.3)
+                            continue
+                        error_step = AgentStep(
+                            step_number=step_num, type="error",
+                            content=f"LLM не ответил за {llm_timeout}с после {max_retries} попыток",
+                        )
+                        await emit(error_step)
+                        return f"LLM не ответил за {llm_timeout}с. Попробуйте повторить запрос."
+                    except Exception as e:
+                        _log_exception(f"❌ [Agent] LLM error (attempt {attempt}):", e)
+                        if attempt < max_retries:
+                            await asyncio.sleep((2 ** attempt) * 0.5 + random.random() * 0.3)
+                            continue
+                        error_step = AgentStep(
+                            step_number=step_num, type="error",
+                            content=f"Ошибка LLM: {str(e)}",
+                        )
+                        await emit(error_step)
+                        return f"Произошла ошибка при обращении к AI: {str(e)}"
 
             if not response or not response.choices:
                 print(f"⚠️ [Agent] LLM returned empty response (no choices)")
@@ -692,8 +1224,7 @@ class AgentEngine:
                     step_number=step_num, type="error",
                     content="LLM вернул пустой ответ. Повторяю...",
                 )
-                if on_step:
-                    await on_step(error_step)
+                await emit(error_step)
                 continue
 
             choice = response.choices[0]
@@ -710,13 +1241,16 @@ class AgentEngine:
                     content=message.content.strip(),
                 )
                 self.steps.append(llm_step)
-                if on_step:
-                    await on_step(llm_step)
+                await emit(llm_step)
 
             # If no tool calls — agent is done
-            if not message.tool_calls:
+            calls = message.tool_calls
+            if not calls:
                 final_text = message.content or "Готово!"
-                self.messages.append({"role": "assistant", "content": final_text})
+                self._append({"role": "assistant", "content": final_text})
+                # The session is idle from here until the next user turn —
+                # summarize the old history now so that turn doesn't wait
+                self._precompute_summary_for_next_turn()
 
                 final_step = AgentStep(
                     step_number=step_num,
@@ -724,48 +1258,44 @@ class AgentEngine:
                     content=final_text,
                 )
                 self.steps.append(final_step)
-                if on_step:
-                    await on_step(final_step)
+                await emit(final_step)
 
                 return final_text
 
             # ── Process tool calls ────────────────────────────────
-            self.messages.append({
+            # The chain is incomplete until every tool result is appended —
+            # treat the history as dirty so a stop or exception in between
+            # can't leak an orphan chain past the validation skip.
+            was_dirty = self._messages_dirty
+            self._messages_dirty = True
+            serialized_calls = []
+            for tc in calls:
+                fn = tc.function
+                serialized_calls.append({
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {"name": fn.name, "arguments": fn.arguments},
+                })
+            self._append({
                 "role": "assistant",
                 "content": message.content or "",
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments,
-                        }
-                    }
-                    for tc in message.tool_calls
-                ]
+                "tool_calls": serialized_calls,
             })
 
             # Execute tool calls
             async def execute_single_tool(tool_call, step_offset):
                 """Execute a single tool call and return result with metadata."""
-                tool_name = tool_call.function.name
+                fn = tool_call.function
+                tool_name = fn.name
 
                 # Parse arguments
                 _json_was_truncated = False
                 try:
-                    if tool_call.function.arguments:
-                        args_str = tool_call.function.arguments
-                        try:
-                            tool_args = json.loads(args_str)
-                        except json.JSONDecodeError:
-                            _json_was_truncated = True
-                            print(f"⚠️ [Agent] JSON parse error for {tool_name}, attempting fix...")
-                            tool_args = self._repair_json_args(tool_name, args_str)
-                    else:
-                        tool_args = {}
+                    tool_args, _json_was_truncated = self._parse_tool_args(
+                        tool_name, fn.arguments
+                    )
                 except Exception as e:
-                    print(f"❌ [Agent] Unexpected error parsing arguments for {tool_name}:\n{traceback.format_exc()}")
+                    _log_exception(f"❌ [Agent] Unexpected error parsing arguments for {tool_name}:", e)
                     tool_args = {}
 
                 if not tool_args and tool_name == "write_file":
@@ -790,13 +1320,8 @@ class AgentEngine:
                         tool_name=tool_name, tool_result=truncated_result,
                     )
                     self.steps.append(result_step)
-                    if on_step:
-                        await on_step(result_step)
-                    return {
-                        "tool_call_id": tool_call.id,
-                        "tool_name": tool_name,
-                        "result": truncated_result,
-                    }
+                    await emit(result_step)
+                    return ToolOutcome(tool_call.id, tool_name, truncated_result)
 
                 # Notify: tool call
                 call_step = AgentStep(
@@ -807,8 +1332,7 @@ class AgentEngine:
                     tool_args=tool_args,
                 )
                 self.steps.append(call_step)
-                if on_step:
-                    await on_step(call_step)
+                await emit(call_step)
 
                 print(f"🔧 [Agent] Вызываю инструмент: {tool_name}")
 
@@ -817,7 +1341,7 @@ class AgentEngine:
                     result = await self.tool_executor.execute(tool_name, tool_args)
                     print(f"📋 [Agent] {tool_name}: {'✅' if result.get('success') else '❌'}")
                 except Exception as e:
-                    print(f"❌ [Agent] Ошибка выполнения {tool_name}:\n{traceback.format_exc()}")
+                    _log_exception(f"❌ [Agent] Ошибка выполнения {tool_name}:", e)
                     result = {"success": False, "error": str(e), "result": None}
 
                 # ── Record for escalation ─────────────────────────
@@ -836,142 +1360,98 @@ class AgentEngine:
                     tool_result=result,
                 )
                 self.steps.append(result_step)
-                if on_step:
-                    await on_step(result_step)
-
-                return {
-                    "tool_call_id": tool_call.id,
-                    "tool_name": tool_name,
-                    "result": result,
-                }
-
-            # ── Parallel execution of independent tools ───────────
-            tool_results = []
-            independent_tools = {
-                'read_file', 'write_file', 'list_files',
-                'browser_screenshot', 'browser_get_content',
-                'browser_get_page_structure',
-                'browser_get_console_logs', 'browser_get_network_failures',
-                'browser_execute_script', 'browser_scroll',
-            }
-
-            current_step = 0
-            i = 0
-            while i < len(message.tool_calls):
-                tool_call = message.tool_calls[i]
+                await emit(result_step)
+
+                return ToolOutcome(tool_call.id, tool_name, result)
 
+            # ── Parallel execution: wave scheduler ────────────────
+            # Waves let independent tools overlap even across a dependent
+            # call (a read_file can run while browser_navigate loads), see
+            # _schedule_tool_calls. Results land by original index so the
+            # tool messages keep the call order regardless of completion
+            # order.
+            tool_results: list[Optional[ToolOutcome]] = [None] * len(calls)
+
+            async def run_guarded(idx: int, tool_call):
+                """execute_single_tool that can't raise into the TaskGroup."""
+                try:
+                    outcome = await execute_single_tool(tool_call, idx * 2)
+                except Exception as exc:
+                    tn = tool_call.function.name if getattr(tool_call, "function", None) else "unknown"
+                    print(f"❌ [Agent] Tool wave item failed ({tn}): {exc}")
+                    outcome = ToolOutcome(
+                        tool_call.id, tn,
+                        {"success": False, "error": str(exc), "result": None},
+                    )
+                tool_results[idx] = outcome
+
+            done_calls = 0
+            for wave in self._schedule_tool_calls(calls):
+                # Stop is checked at wave boundaries: in-flight tools have
+                # to drain anyway, so nothing is lost in responsiveness
                 if stop_check():
                     stop_step = AgentStep(
-                        step_number=step_num + current_step + 1,
+                        step_number=step_num + done_calls * 2 + 1,
                         type="response",
                         content="⏹️ Выполнение остановлено пользователем",
                     )
-                    if on_step:
-                        await on_step(stop_step)
+                    await emit(stop_step)
                     return "Выполнение остановлено пользователем"
 
-                tool_name = tool_call.function.name
-
-                if tool_name in independent_tools:
-                    batch = [tool_call]
-                    j = i + 1
-                    while j < len(message.tool_calls):
-                        if message.tool_calls[j].function.name in independent_tools:
-                            batch.append(message.tool_calls[j])
-                            j += 1
-                        else:
-                            break
-
-                    if len(batch) > 1:
-                        print(f"⚡ [Agent] Параллельное выполнение {len(batch)} независимых инструментов")
-                        tasks = [
-                            execute_single_tool(tc, current_step + idx * 2)
-                            for idx, tc in enumerate(batch)
-                        ]
-                        batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-                        for idx, br in enumerate(batch_results):
-                            if isinstance(br, Exception):
-                                tc = batch[idx]
-                                tn = tc.function.name if getattr(tc, "function", None) else "unknown"
-                                print(f"❌ [Agent] Tool batch item failed ({tn}): {br}")
-                                tool_results.append({
-                                    "tool_call_id": tc.id,
-                                    "tool_name": tn,
-                                    "result": {"success": False, "error": str(br), "result": None},
-                                })
-                            elif isinstance(br, dict):
-                                tool_results.append(br)
-                            else:
-                                tc = batch[idx]
-                                tn = tc.function.name if getattr(tc, "function", None) else "unknown"
-                                print(f"⚠️ [Agent] Tool batch item returned non-dict ({tn}): {type(br).__name__}")
-                                tool_results.append({
-                                    "tool_call_id": tc.id,
-                                    "tool_name": tn,
-                                    "result": {"success": False, "error": "Tool returned invalid result", "result": None},
-                                })
-                        current_step += len(batch) * 2
-                        i += len(batch)
-                    else:
-                        result = await execute_single_tool(tool_call, current_step)
-                        if isinstance(result, dict):
-                            tool_results.append(result)
-                        else:
-                            print(f"⚠️ [Agent] Tool returned non-dict: {type(result).__name__}")
-                            tool_results.append({
-                                "tool_call_id": tool_call.id,
-                                "tool_name": tool_name,
-                                "result": {"success": False, "error": "Tool returned invalid result", "result": None},
-                            })
-                        current_step += 2
-                        i += 1
+                if len(wave) == 1:
+                    idx, tool_call = wave[0]
+                    await run_guarded(idx, tool_call)
                 else:
-                    result = await execute_single_tool(tool_call, current_step)
-                    if isinstance(result, dict):
-                        tool_results.append(result)
-                    else:
-                        print(f"⚠️ [Agent] Tool returned non-dict: {type(result).__name__}")
-                        tool_results.append({
-                            "tool_call_id": tool_call.id,
-                            "tool_name": tool_name,
-                            "result": {"success": False, "error": "Tool returned invalid result", "result": None},
-                        })
-                    current_step += 2
-                    i += 1
+                    print(f"⚡ [Agent] Параллельное выполнение {len(wave)} инструментов (волна)")
+                    async with asyncio.TaskGroup() as tg:
+                        for idx, tool_call in wave:
+                            tg.create_task(run_guarded(idx, tool_call))
+                done_calls += len(wave)
 
             # ── Add tool messages with smart compression ──────────
+            chain_complete = True
             for tr in tool_results:
-                if not isinstance(tr, dict):
-                    print(f"⚠️ [Agent] Skipping malformed tool result item: {type(tr).__name__}")
-                    continue
-                result = tr.get("result")
-                t_name = tr.get("tool_name", "unknown")
-                t_call_id = tr.get("tool_call_id")
-                if t_call_id is None:
+                # Every outcome is a ToolOutcome (run_guarded guarantees
+                # it) — only a missing id still forces a chain break
+                if tr is None or tr.tool_call_id is None:
                     print(f"⚠️ [Agent] Skipping tool result without tool_call_id: {tr}")
+                    chain_complete = False
                     continue
+                result = tr.result
+                t_name = tr.tool_name
                 if not isinstance(result, dict):
                     result = {"success": False, "error": "Malformed tool result", "result": None}
 
-                # Serialize and compress using the context module
-                raw_json = json.dumps(result, ensure_ascii=False)
-                compressed = compress_tool_result(t_name, raw_json)
+                # Compress straight from the dict: the heavy fields are
+                # trimmed before anything is serialized, so a multi-MB
+                # payload never becomes a multi-MB JSON string first.
+                if _result_payload_chars(result) > _COMPRESS_OFFLOAD_CHARS:
+                    # Still linear scans over the big strings inside —
+                    # push them off the event loop like docker I/O is
+                    compressed = await asyncio.to_thread(
+                        compress_tool_result_dict, t_name, result
+                    )
+                else:
+                    compressed = compress_tool_result_dict(t_name, result)
 
-                self.messages.append({
+                self._append({
                     "role": "tool",
-                    "tool_call_id": t_call_id,
+                    "tool_call_id": tr.tool_call_id,
                     "content": compressed,
                 })
 
-        extension = max(0, int(getattr(settings, "AGENT_ITERATION_EXTENSION", 0) or 0))
+            # Every tool result landed → the chain is complete again
+            if chain_complete:
+                self._messages_dirty = was_dirty
+
+        extension = ITERATION_EXTENSION
         if allow_auto_extend and extension > 0 and not stop_check() and not self.escalation.is_stuck:
             note = (
                 f"⚙️ Достигнут лимит {max_iterations} итераций, "
                 f"автоматически добавляю ещё {extension} для завершения задачи..."
             )
             extend_step = AgentStep(step_number=step_num + 1, type="thinking", content=note)
-            if on_step:
-                await on_step(extend_step)
+            await emit(extend_step)
             print(f"🔁 [Agent] Auto-extending iterations: +{extension}")
             return await self._run_loop(
                 step_num,
@@ -985,38 +1465,89 @@ class AgentEngine:
 
         return "Достигнут лимит итераций. Задача слишком сложная — попробуйте разбить на подзадачи."
 
+    @staticmethod
+    def _schedule_tool_calls(tool_calls) -> list[list[tuple[int, object]]]:
+        """Group one turn's tool calls into waves of concurrent execution.
+
+        Read-only tools (and single-file writes) are independent and share
+        a wave. Mutators act as barriers, but only within their own domain:
+        file tools (write_files) and browser tools (navigate/click/...)
+        don't conflict with each other, so e.g. a read_file scheduled after
+        browser_navigate joins the navigate's wave instead of waiting out
+        the page load. execute_command (and unknown tools) can touch both
+        the filesystem and the browser environment → full barrier, which
+        matches the old serial behaviour exactly.
+        """
+        waves: list[list[tuple[int, object]]] = []
+        # Per-domain frontiers: avail — the earliest wave an independent of
+        # that domain may join; used — the highest wave the domain occupies
+        avail = {"file": 0, "browser": 0}
+        used = {"file": -1, "browser": -1}
+
+        for idx, tc in enumerate(tool_calls):
+            name = tc.function.name if getattr(tc, "function", None) else ""
+            is_browser = name.startswith("browser_")
+            domain = "browser" if is_browser else "file"
+            if name in _INDEPENDENT_TOOLS:
+                wave = avail[domain]
+                if wave > used[domain]:
+                    used[domain] = wave
+            elif is_browser or name == "write_files":
+                # Domain-local mutator: barriers its own domain only
+                wave = max(avail[domain], used[domain] + 1)
+                avail[domain] = wave + 1
+                used[domain] = wave
+            else:
+                # execute_command / unknown tool: full barrier
+                wave = max(avail["file"], used["file"] + 1,
+                           avail["browser"], used["browser"] + 1)
+                avail["file"] = avail["browser"] = wave + 1
+                used["file"] = used["browser"] = wave
+            while len(waves) <= wave:
+                waves.append([])
+            waves[wave].append((idx, tc))
+        return waves
+
+    def _parse_tool_args(self, tool_name: str, args_str: str) -> tuple[dict, bool]:
+        """Parse tool_call arguments; returns (args, was_repaired).
+
+        orjson is noticeably faster than stdlib json on typical tool_args
+        blobs; malformed output (truncated write_file JSON is the common
+        case) falls through to the regex repair path.
+        """
+        # Argument-less tools send "{}" (or occasionally "null") — resolve
+        # those without touching the parser at all
+        if not args_str or args_str in ("{}", "null"):
+            return {}, False
+        try:
+            return orjson.loads(args_str), False
+        except orjson.JSONDecodeError:
+            print(f"⚠️ [Agent] JSON parse error for {tool_name}, attempting fix...")
+            return self._repair_json_args(tool_name, args_str), True
+
     def _repair_json_args(self, tool_name: str, args_str: str) -> dict:
         """Attempt to repair malformed JSON from LLM."""
         print(f"⚠️ [Agent] Malformed JSON for {tool_name}: '{args_str[:300]}...'")
 
         if tool_name == "write_file":
-            filepath_regex, content_regex = AgentEngine._get_regex_patterns()
             tool_args = {"filepath": "", "content": ""}
-            filepath_match = filepath_regex.search(args_str)
-            content_match = content_regex.search(args_str)
+            filepath_match = _FILEPATH_RE.search(args_str)
+            content_match = _CONTENT_RE.search(args_str)
 
             if filepath_match:
                 tool_args["filepath"] = filepath_match.group(1)
                 if content_match:
-                    import re
                     content = content_match.group(1)
-                    content = re.sub(r'"\s*[,}].*$', '', content, flags=re.DOTALL)
-                    content = (content
-                               .replace('\\n', '\n')
-                               .replace('\\t', '\t')
-                               .replace('\\"', '"')
-                               .replace('\\\\', '\\'))
-                    tool_args["content"] = content
+                    content = _CONTENT_TAIL_RE.sub('', content)
+                    tool_args["content"] = _unescape_json(content)
                 print(f"✅ [Agent] Extracted: filepath={tool_args['filepath']}, "
                       f"content_len={len(tool_args.get('content', ''))}")
             return tool_args
 
         if tool_name == "write_files":
-            import re
-            filepath_regex, content_regex = AgentEngine._get_regex_patterns()
             files = []
             # Try to extract individual file objects from truncated JSON
-            for m in re.finditer(r'\{\s*"filepath"\s*:\s*"([^"]+)"\s*,\s*"content"\s*:\s*"', args_str):
+            for m in _WRITE_FILES_RE.finditer(args_str):
                 fp = m.group(1)
                 start = m.end()
                 # Find end of this content string (may be truncated)
@@ -1024,12 +1555,7 @@ class AgentEngine:
                 if end == -1:
                     end = len(args_str)
                 raw = args_str[start:end]
-                raw = (raw
-                       .replace('\\n', '\n')
-                       .replace('\\t', '\t')
-                       .replace('\\"', '"')
-                       .replace('\\\\', '\\'))
-                files.append({"filepath": fp, "content": raw})
+                files.append({"filepath": fp, "content": _unescape_json(raw)})
             if files:
                 print(f"✅ [Agent] Repaired write_files: extracted {len(files)} file(s)")
                 return {"files": files}
@@ -1041,67 +1567,12 @@ class AgentEngine:
     def _summarize_result(self, tool_name: str, result: dict) -> str:
         """Create a human-readable summary of a tool result."""
         if not result.get("success", False):
-            return f"❌ Ошибка: {result.get('error', 'unknown')}"
-
-        r = result.get("result", {})
+            return f"\u274c \u041e\u0448\u0438\u0431\u043a\u0430: {result.get('error', 'unknown')}"
 
-        if tool_name == "execute_command":
-            exit_code = r.get("exit_code", -1)
-            if exit_code == 0:
-                stdout = r.get("stdout", "").strip()
-                return f"✅ Команда выполнена" + (f": {stdout[:200]}" if stdout else "")
-            else:
-                stderr = r.get("stderr", "").strip()
-                return f"⚠️ Код выхода {exit_code}: {stderr[:200]}"
-
-        elif tool_name == "write_file":
-            return f"✅ Файл создан: {r.get('filepath', '?')}"
-
-        elif tool_name == "write_files":
-            written = r.get("written", [])
-            errs = r.get("errors")
-            if errs:
-                return f"✅ Записано файлов: {len(written)}, ошибок: {len(errs)}"
-            return f"✅ Записано файлов: {len(written)}"
-
-        elif tool_name == "read_file":
-            content = r.get("content", "")
-            lines = len(content.split("\n"))
-            return f"📄 Прочитан файл: {r.get('filepath', '?')} ({lines} строк)"
-
-        elif tool_name == "list_files":
-            files = r.get("files", [])
-            return f"📁 Найдено {len(files)} файлов в {r.get('path', '?')}"
-
-        elif tool_name == "browser_get_page_structure":
-            el = r.get("elements", [])
-            return f"✅ На странице {len(el)} элементов (inputs/buttons). Используй их selector для type и click."
-        elif tool_name == "browser_select":
-            return f"✅ Выбрана опция: {r.get('selector', '?')}"
-        elif tool_name == "browser_fill_form":
-            return f"✅ Форма заполнена: {r.get('filled', 0)} полей, URL: {r.get('url', '')[:50]}"
-        elif tool_name == "browser_screenshot":
-            pt = r.get("page_text", "")
-            if len(pt) > 150:
-                return f"✅ Скриншот сохранён. Текст страницы: {pt[:150]}..."
-            return f"✅ Скриншот сохранён. Текст страницы: {pt or '(пусто)'}"
-        elif tool_name == "browser_get_console_logs":
-            logs = r.get("logs", [])
-            if logs:
-                return f"✅ Консоль: {len(logs)} записей. Используй для поиска JS-ошибок."
-            return "✅ Консоль: записей нет."
-        elif tool_name == "browser_get_network_failures":
-            fails = r.get("request_failures", [])
-            bad = r.get("bad_status_responses", [])
-            return f"✅ Сеть: {len(fails)} сбоев запросов, {len(bad)} ответов 4xx/5xx."
-        elif tool_name == "browser_execute_script":
-            script_result = r.get('result')
-            preview = str(script_result if script_result is not None else 'ok')
-            return f"✅ Скрипт выполнен: {preview[:80]}"
-        elif tool_name == "browser_scroll":
-            return f"✅ Страница прокручена: {r.get('scrolled', 'ok')}"
-
-        return f"✅ {tool_name} выполнен"
+        summarize = _SUMMARIZERS.get(tool_name)
+        if summarize is None:
+            return f"\u2705 {tool_name} \u0432\u044b\u043f\u043e\u043b\u043d\u0435\u043d"
+        return summarize(result.get("result", {}))
 
     async def _run_multi_agent(
         self,
@@ -1190,7 +1661,7 @@ class AgentEngine:
             return final_message
 
         except Exception as e:
-            print(f"❌ [Agent] Multi-agent workflow error:\n{traceback.format_exc()}")
+            _log_exception("❌ [Agent] Multi-agent workflow error:", e)
             error_msg = f"Ошибка в multi-agent workflow: {str(e)}"
             error_step = AgentStep(
                 step_number=999,
@@ -19,9 +19,9 @@ Usage:
         esc.mark_escalated(target)
 """
 
-import hashlib
-import json
-from dataclasses import dataclass, field
+import orjson
+import zlib
+from dataclasses import dataclass
 
 
 @dataclass
@@ -39,7 +39,8 @@ class EscalationState:
     # ── Internal counters ─────────────────────────────────────────
     consecutive_errors: int = 0
     total_iterations: int = 0
-    _last_call_sigs: list = field(default_factory=list)
+    _last_sig: str = ""
+    _same_sig_count: int = 0
     _escalation_count: int = 0
     _iterations_since_escalation: int = 0
 
@@ -60,10 +61,14 @@ class EscalationState:
         else:
             self.consecutive_errors += 1
 
+        # Rolling repeat counter: a run of identical signatures is the only
+        # thing loop detection ever looks for, so count it as calls arrive.
         sig = f"{tool_name}:{args_hash}"
-        self._last_call_sigs.append(sig)
-        if len(self._last_call_sigs) > 12:
-            self._last_call_sigs = self._last_call_sigs[-12:]
+        if sig == self._last_sig:
+            self._same_sig_count += 1
+        else:
+            self._last_sig = sig
+            self._same_sig_count = 1
 
     def should_escalate(self) -> bool:
         """Should we switch to a more capable model?"""
@@ -77,11 +82,8 @@ class EscalationState:
         if self.consecutive_errors >= self.MAX_CONSECUTIVE_ERRORS:
             return True
 
-        n = self.MAX_REPEATED_CALLS
-        if len(self._last_call_sigs) >= n:
-            last_n = self._last_call_sigs[-n:]
-            if len(set(last_n)) == 1:
-                return True
+        if self._is_looping():
+            return True
 
         if (self.total_iterations >= self.STALL_ITERATION_THRESHOLD
                 and self.consecutive_errors > 0):
@@ -98,10 +100,7 @@ class EscalationState:
                 or self._is_looping())
 
     def _is_looping(self) -> bool:
-        n = self.MAX_REPEATED_CALLS
-        if len(self._last_call_sigs) >= n:
-            return len(set(self._last_call_sigs[-n:])) == 1
-        return False
+        return self._same_sig_count >= self.MAX_REPEATED_CALLS
 
     def get_escalation_target(self) -> str:
         """Which provider to escalate to."""
@@ -119,7 +118,8 @@ class EscalationState:
         self._iterations_since_escalation = 0
         self.current_provider = new_provider
         self.consecutive_errors = 0
-        self._last_call_sigs.clear()
+        self._last_sig = ""
+        self._same_sig_count = 0
 
     def get_escalation_hint(self) -> str:
         """System-level hint to inject into messages after escalation."""
@@ -133,7 +133,11 @@ class EscalationState:
 def make_args_hash(tool_args: dict) -> str:
     """Fast 8-char hash of tool arguments for loop detection."""
     try:
-        raw = json.dumps(tool_args, sort_keys=True, ensure_ascii=False)
+        raw = orjson.dumps(tool_args, option=orjson.OPT_SORT_KEYS)
     except (TypeError, ValueError):
-        raw = str(tool_args)
-    return hashlib.md5(raw.encode()).hexdigest()[:8]
+        raw = str(tool_args).encode()
+    # crc32 over the sorted bytes: the hash is only ever compared for
+    # equality against the previous call's signature (_last_sig rolling
+    # counter), so a fast non-crypto checksum is plenty and avoids md5's
+    # setup cost per tool call.
+    return format(zlib.crc32(raw), "08x")
@@ -1,10 +1,14 @@
 """
 Planner Agent — декомпозирует задачу на шаги.
 """
+import re
 from typing import Optional, Callable, Awaitable
 from llm.router import llm_router
 from agents.engine import AgentStep
 
+# A line opening a new plan step: "1.", "12.", "- ", "Step 3" …
+_STEP_PREFIX_RE = re.compile(r'(?:\d+\.|Step\s+\d+\b|-)')
+
 
 PLANNER_SYSTEM_PROMPT = """You are a Planning Agent. Your job is to break down user tasks into clear, actionable steps.
 
@@ -16,6 +20,11 @@ Analyze the user's request and create a detailed plan with:
 
 Return your plan as a structured list. Be specific and actionable."""
 
+# One shared system message for every plan request: the prompt never
+# changes, and a byte-identical prefix lets providers serve it from
+# their server-side prompt cache.
+_SYSTEM_MSG = {"role": "system", "content": PLANNER_SYSTEM_PROMPT}
+
 
 class PlannerAgent:
     """Plans the execution of user tasks by breaking them into steps."""
@@ -41,7 +50,7 @@ class PlannerAgent:
             }
         """
         messages = [
-            {"role": "system", "content": PLANNER_SYSTEM_PROMPT},
+            _SYSTEM_MSG,
             {"role": "user", "content": f"Create a detailed plan for this task:\n\n{user_task}"}
         ]
 
@@ -90,7 +99,7 @@ class PlannerAgent:
                 continue
             
             # Look for numbered steps (1., 2., Step 1, etc.)
-            if any(line.startswith(prefix) for prefix in ['1.', '2.', '3.', '4.', '5.', 'Step 1', 'Step 2', '-']):
+            if _STEP_PREFIX_RE.match(line):
                 if current_step:
                     steps.append(current_step)
                 
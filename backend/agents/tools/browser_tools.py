@@ -3,156 +3,663 @@ Browser Tools — Playwright browser automation executed in Docker sandbox.
 Uses a persistent browser instance via CDP (Chrome DevTools Protocol).
 """
 import asyncio
-import base64
+import hashlib
 import json
+import os
 import time
+from config import settings
 from docker_manager.manager import docker_manager
 
 
-# Script that runs persistently in the sandbox to keep browser alive
-BROWSER_SERVER_SCRIPT = '''#!/usr/bin/env python3
-"""Persistent browser server using Playwright. Keeps browser alive between actions."""
-import asyncio
-import json
-import sys
-import os
-import signal
+# Общий диспетчер действий: одна и та же логика встраивается и в одноразовый
+# скрипт (BROWSER_ACTION_SCRIPT), и в постоянный сервер (BROWSER_SERVER_SCRIPT),
+# чтобы пути не расходились
+_ACTION_DISPATCH_SRC = '''
+async def attach_failure_artifacts(page, action, result_obj):
+    """Attach debug metadata for failed actions so incidents are easier to investigate."""
+    if not isinstance(result_obj, dict) or result_obj.get('success', True):
+        return result_obj
+    if not page:
+        return result_obj
 
-from playwright.async_api import async_playwright
+    try:
+        screenshots_dir = '/workspace/.screenshots'
+        os.makedirs(screenshots_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        debug_path = f'{screenshots_dir}/failure_{action}_{timestamp}.png'
+        await page.screenshot(path=debug_path, full_page=True)
+        result_obj['debug_screenshot_path'] = debug_path.replace('/workspace/', '')
+    except Exception:
+        pass
 
-SOCKET_PATH = "/tmp/browser_server.sock"
-STEALTH_SCRIPT = """
-Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
-Object.defineProperty(navigator, 'plugins', { get: () => [1, 2, 3, 4, 5] });
-Object.defineProperty(navigator, 'languages', { get: () => ['en-US', 'en'] });
-window.chrome = { runtime: {} };
-"""
+    try:
+        result_obj['url'] = page.url
+        result_obj['title'] = await page.title()
+    except Exception:
+        pass
+    return result_obj
 
-browser = None
-context = None
-page = None
 
+# Счётчик ревизий DOM: MutationObserver инкрементирует window.__domRev при
+# любом изменении. Ставится лениво при первом запросе текста. Эпоха — случайная
+# метка документа: после любой навигации (включая перезагрузку того же URL)
+# документ новый, счётчик снова 0, и только эпоха отличает его от прежнего
+_DOM_REV_JS = """() => {
+    if (window.__domRevInstalled) return [window.__domEpoch, window.__domRev || 0];
+    window.__domRevInstalled = true;
+    window.__domEpoch = Date.now() + Math.random();
+    window.__domRev = 0;
+    new MutationObserver(() => { window.__domRev++; })
+        .observe(document.documentElement, { childList: true, subtree: true, characterData: true, attributes: true });
+    return [window.__domEpoch, 0];
+}"""
 
-async def ensure_browser():
-    """Ensure browser is running, start if not."""
-    global browser, context, page
-    
-    if browser and browser.is_connected():
-        if page and not page.is_closed():
-            return page
-        # Page closed, create new one
-        page = await context.new_page()
-        return page
-    
-    pw = await async_playwright().start()
-    browser = await pw.chromium.launch(
-        headless=False,
-        args=[
-            '--no-sandbox',
-            '--disable-setuid-sandbox',
-            '--disable-blink-features=AutomationControlled',
-            '--disable-dev-shm-usage',
-        ]
-    )
-    context = await browser.new_context(
-        viewport={'width': 1280, 'height': 720},
-        ignore_https_errors=True,
-        user_agent='Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        locale='en-US',
-        timezone_id='America/New_York',
-    )
-    await context.add_init_script(STEALTH_SCRIPT)
-    page = await context.new_page()
-    return page
+# Кэш innerText по ключу (url, эпоха документа, ревизия DOM). Живёт в глобалах
+# скрипта, так что окупается в постоянном сервере; одноразовый процесс теряет
+# его на выходе
+_page_text_cache = {}
 
 
-async def handle_action(action, args):
-    """Handle a browser action."""
-    import base64
-    from datetime import datetime
-    
-    pg = await ensure_browser()
-    
+async def get_page_text(page):
+    """document.body.innerText с мемоизацией: повторный запрос без изменений
+    DOM не гоняет полный текст страницы через протокол заново."""
+    key = None
+    try:
+        epoch, rev = await page.evaluate(_DOM_REV_JS)
+        key = (page.url, epoch, rev)
+        cached = _page_text_cache.get(key)
+        if cached is not None:
+            return cached
+    except Exception:
+        pass
+    text = (await page.evaluate('document.body.innerText')) or ''
+    if key is not None:
+        if len(_page_text_cache) > 8:
+            _page_text_cache.clear()
+        _page_text_cache[key] = text
+    return text
+
+
+# Кэш CDP-компиляции: Runtime.compileScript выполняется один раз на скрипт,
+# повторные запуски идут через Runtime.runScript без повторного парсинга JS.
+# Окупается только в постоянном сервере; в одноразовом процессе путь
+# эквивалентен обычному evaluate
+_cdp_eval_cache = {}
+
+_PAGE_STRUCTURE_JS = """() => {
+    const out = [];
+    const INTERACTIVE_TAGS = new Set(['INPUT', 'TEXTAREA', 'SELECT', 'BUTTON']);
+    const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_ELEMENT);
+    let el;
+    while ((el = walker.nextNode())) {
+        const tagUpper = el.tagName || '';
+        const role = ((el.getAttribute('role') || '') + '').toLowerCase();
+        const isRoleCombo = role === 'combobox';
+        const isRoleListbox = role === 'listbox';
+        if (!INTERACTIVE_TAGS.has(tagUpper) &&
+            role !== 'button' && !isRoleCombo && !isRoleListbox &&
+            !(tagUpper === 'A' && el.hasAttribute('href'))) continue;
+        if (!(el.offsetParent || (el.getClientRects && el.getClientRects().length))) continue;
+
+        const tag = tagUpper.toLowerCase();
+        const type = ((el.type || '') + '').toLowerCase();
+        const name = el.name || '';
+        const isSelect = tag === 'select';
+        const isNativeMultiSelect = isSelect && !!el.multiple;
+        const isAriaMultiSelect = (isRoleCombo || isRoleListbox) &&
+            (((el.getAttribute('aria-multiselectable') || '') + '').toLowerCase() === 'true');
+        const optionsCount = isSelect ? el.options.length : Number(el.getAttribute('aria-setsize') || 0) || null;
+
+        let selector;
+        if (el.id) {
+            selector = '#' + CSS.escape(el.id);
+        } else if (name && (tag === 'input' || tag === 'textarea' || tag === 'select')) {
+            selector = tag + '[name="' + name.replace(/"/g, '\\\\"') + '"]';
+        } else {
+            const dt = el.getAttribute('data-testid') || el.getAttribute('data-test') || el.getAttribute('data-qa');
+            if (dt) selector = '[data-testid="' + dt.replace(/"/g, '\\\\"') + '"]';
+            else if (type && tag === 'input') selector = 'input[type="' + type + '"]';
+            else selector = tag;
+        }
+
+        const labelEl = el.closest('label');
+        out.push({
+            kind: tag === 'a' ? 'link' : tag,
+            selector,
+            tag,
+            role: role || null,
+            control_type: isNativeMultiSelect || isAriaMultiSelect ? 'multiselect' : (isSelect || isRoleCombo || isRoleListbox ? 'select' : 'input'),
+            type: type || null,
+            name: name || null,
+            placeholder: (el.placeholder || '').slice(0, 60) || null,
+            label: (el.getAttribute('aria-label') || el.title || (labelEl && labelEl.innerText) || '').trim().slice(0, 80),
+            text: ((el.value !== undefined ? el.value : el.innerText) || '').trim().slice(0, 60) || null,
+            is_select: isSelect || isRoleCombo || isRoleListbox,
+            is_multiselect: isNativeMultiSelect || isAriaMultiSelect,
+            options_count: optionsCount,
+        });
+        if (out.length >= 60) break;
+    }
+    return out;
+}"""
+
+
+async def evaluate_compiled(page, js_function_src):
+    """page.evaluate с кэшем компиляции через CDP. Любая ошибка CDP
+    (нет сессии, контекст уничтожен навигацией) тихо откатывает на
+    обычный page.evaluate."""
+    key = id(page)
+    try:
+        entry = _cdp_eval_cache.get(key)
+        if entry is None:
+            session = await page.context.new_cdp_session(page)
+            entry = _cdp_eval_cache[key] = {'session': session, 'scripts': {}}
+        session = entry['session']
+        expression = '(' + js_function_src + ')()'
+
+        async def compile_once():
+            compiled = await session.send('Runtime.compileScript', {
+                'expression': expression,
+                'sourceURL': 'agent://compiled',
+                'persistScript': True,
+            })
+            script_id = compiled['scriptId']
+            entry['scripts'][js_function_src] = script_id
+            return script_id
+
+        script_id = entry['scripts'].get(js_function_src)
+        if script_id is None:
+            script_id = await compile_once()
+        run_params = {'scriptId': script_id, 'returnByValue': True, 'awaitPromise': True}
+        try:
+            ran = await session.send('Runtime.runScript', run_params)
+        except Exception:
+            # scriptId протух (например, после навигации) — перекомпилируем раз
+            run_params['scriptId'] = await compile_once()
+            ran = await session.send('Runtime.runScript', run_params)
+        if ran.get('exceptionDetails'):
+            raise Exception(ran['exceptionDetails'].get('text', 'runScript failed'))
+        return ran.get('result', {}).get('value')
+    except Exception:
+        _cdp_eval_cache.pop(key, None)
+        return await page.evaluate(js_function_src)
+
+
+async def run_action(page, action, args):
+    """Execute one browser action on the given page; returns a result dict."""
     if action == 'navigate':
         url = args.get('url', '')
-        await pg.goto(url, wait_until='domcontentloaded', timeout=30000)
-        # Wait a bit more for dynamic content
-        await asyncio.sleep(1)
-        return {'success': True, 'url': pg.url, 'title': await pg.title()}
+        timeout = int(args.get('timeout', 30000))
+        await page.goto(url, wait_until='domcontentloaded', timeout=timeout)
+        try:
+            # Дожидаемся затишья сети вместо фиксированной паузы: на быстрых
+            # страницах возврат почти мгновенный
+            await page.wait_for_load_state('networkidle', timeout=min(timeout, 5000))
+        except Exception:
+            pass  # networkidle не наступил — DOM уже загружен, продолжаем
+        result = {'success': True, 'url': page.url, 'title': await page.title()}
     
     elif action == 'click':
         selector = args.get('selector', '')
-        # Try CSS selector first, then text
-        try:
-            await pg.click(selector, timeout=5000)
-        except Exception:
-            # Try by text content
-            await pg.click(f'text="{selector}"', timeout=5000)
-        await asyncio.sleep(0.5)
-        return {'success': True, 'clicked': selector, 'url': pg.url}
+        timeout = int(args.get('timeout', 5000))
+        last_err = None
+        done = False
+        for attempt in range(2):
+            try:
+                if attempt == 1:
+                    await page.wait_for_selector(selector, state='visible', timeout=min(timeout, 2000))
+                await page.click(selector, timeout=timeout)
+                done = True
+                break
+            except Exception as e1:
+                last_err = e1
+                try:
+                    await page.click('text="' + selector.replace('"', '\\\\"') + '"', timeout=timeout)
+                    done = True
+                    break
+                except Exception as e2:
+                    last_err = e2
+                    try:
+                        await page.get_by_text(selector, exact=False).first.click(timeout=timeout)
+                        done = True
+                        break
+                    except Exception as e3:
+                        last_err = e3
+            if not done and attempt == 0:
+                await asyncio.sleep(0.8)
+        if done:
+            try:
+                await page.wait_for_load_state('domcontentloaded', timeout=1500)
+            except Exception:
+                pass
+            result = {'success': True, 'clicked': selector, 'url': page.url}
+        else:
+            result = {'success': False, 'error': 'Element not found: %s. %s' % (selector, last_err)}
     
     elif action == 'type':
         selector = args.get('selector', '')
         text = args.get('text', '')
-        await pg.fill(selector, text)
-        return {'success': True, 'typed': text, 'selector': selector}
+        timeout = int(args.get('timeout', 5000))
+        last_err = None
+        done = False
+        for attempt in range(2):
+            try:
+                await page.fill(selector, text, timeout=timeout)
+                done = True
+                break
+            except Exception as e:
+                last_err = e
+            if not done and attempt == 0:
+                await asyncio.sleep(0.8)
+        if done:
+            result = {'success': True, 'typed': text, 'selector': selector}
+        else:
+            result = {'success': False, 'error': 'Input not found: %s. %s' % (selector, last_err)}
+    
+    elif action == 'fill_form':
+        steps = args.get('steps', [])
+        submit_selector = args.get('submit_selector', '')
+        errors = []
+        applied = []
+        for i, step in enumerate(steps):
+            sel = step.get('selector', '')
+            val = step.get('value', '')
+            if not sel:
+                continue
+            try:
+                field_meta = await page.evaluate("""(selector) => {
+                    const el = document.querySelector(selector);
+                    if (!el) return { exists: false };
+                    const tag = (el.tagName || '').toLowerCase();
+                    const role = ((el.getAttribute('role') || '') + '').toLowerCase();
+                    return {
+                        exists: true,
+                        tag,
+                        role,
+                        inputType: ((el.type || '') + '').toLowerCase(),
+                        isSelect: tag === 'select',
+                        isNativeMultiSelect: tag === 'select' && !!el.multiple,
+                        isAriaMultiSelect: ['listbox', 'combobox'].includes(role) &&
+                            ((el.getAttribute('aria-multiselectable') || '') + '').toLowerCase() === 'true',
+                    };
+                }""", sel)
+
+                if not field_meta or not field_meta.get('exists'):
+                    raise Exception('element not found')
+
+                requested_type = (step.get('type') or '').lower()
+                wants_select = requested_type in ('select', 'dropdown', 'multiselect')
+                is_selectish = field_meta.get('isSelect') or field_meta.get('role') in ('combobox', 'listbox')
+                is_multi = field_meta.get('isNativeMultiSelect') or field_meta.get('isAriaMultiSelect') or requested_type == 'multiselect'
+
+                if wants_select or is_selectish:
+                    selected = False
+                    if step.get('values') and isinstance(step.get('values'), list):
+                        await page.select_option(sel, [str(v) for v in step.get('values')])
+                        selected = True
+                    elif step.get('value'):
+                        if is_multi and isinstance(step.get('value'), str) and ',' in step.get('value'):
+                            values = [x.strip() for x in step.get('value').split(',') if x.strip()]
+                            if values:
+                                await page.select_option(sel, values)
+                                selected = True
+                        if not selected:
+                            await page.select_option(sel, value=str(step['value']))
+                            selected = True
+                    elif step.get('label'):
+                        await page.select_option(sel, label=str(step['label']))
+                        selected = True
+
+                    if not selected:
+                        raise Exception('select field requires value/values/label')
+                    applied.append({'selector': sel, 'mode': 'multiselect' if is_multi else 'select'})
+                else:
+                    await page.fill(sel, str(val))
+                    applied.append({'selector': sel, 'mode': 'text'})
+            except Exception as e:
+                errors.append('%s: %s' % (sel, e))
+        if submit_selector:
+            try:
+                await page.click(submit_selector, timeout=5000)
+                try:
+                    await page.wait_for_load_state('domcontentloaded', timeout=1500)
+                except Exception:
+                    pass
+            except Exception as e:
+                errors.append('submit %s: %s' % (submit_selector, e))
+        if errors:
+            result = {'success': False, 'error': '; '.join(errors), 'url': page.url, 'applied': applied}
+        else:
+            result = {'success': True, 'filled': len(steps), 'url': page.url, 'applied': applied}
+    
+    elif action == 'select':
+        selector = args.get('selector', '')
+        value = args.get('value', '')
+        label = args.get('label', '')
+        try:
+            if value:
+                await page.select_option(selector, value=value)
+                result = {'success': True, 'selector': selector, 'url': page.url}
+            elif label:
+                await page.select_option(selector, label=label)
+                result = {'success': True, 'selector': selector, 'url': page.url}
+            else:
+                result = {'success': False, 'error': 'Provide value or label for select'}
+        except Exception as e:
+            result = {'success': False, 'error': 'Select failed: %s. %s' % (selector, e)}
     
     elif action == 'screenshot':
         full_page = args.get('full_page', False)
-        screenshot = await pg.screenshot(full_page=full_page, type='png')
-        screenshot_b64 = base64.b64encode(screenshot).decode('utf-8')
-        # Save to file
+        screenshot = await page.screenshot(full_page=full_page, type='png')
+        # PNG уходит в bind-mounted каталог проекта; base64-копия в JSON-ответе
+        # не нужна — хост читает файл по пути
         screenshots_dir = '/workspace/.screenshots'
         os.makedirs(screenshots_dir, exist_ok=True)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         path = f'{screenshots_dir}/screenshot_{timestamp}.png'
         with open(path, 'wb') as f:
             f.write(screenshot)
-        return {
+        page_text = (await get_page_text(page)).strip() if page else ''
+        result = {
             'success': True,
-            'screenshot': screenshot_b64[:100] + '...(truncated)',
             'screenshot_path': path.replace('/workspace/', ''),
-            'full_base64_length': len(screenshot_b64),
+            'size_bytes': len(screenshot),
+            'page_text': (page_text or '')[:5000],
         }
     
     elif action == 'get_content':
         selector = args.get('selector', '')
         if selector:
-            text = await pg.text_content(selector)
+            text = await page.text_content(selector)
         else:
-            text = await pg.evaluate('document.body.innerText')
-        return {'success': True, 'content': (text or '')[:5000], 'url': pg.url}
+            text = await get_page_text(page)
+        result = {'success': True, 'content': (text or '')[:5000], 'url': page.url}
+    
+    elif action == 'get_page_structure':
+        await page.wait_for_load_state('domcontentloaded')
+        try:
+            await page.wait_for_load_state('networkidle', timeout=2000)
+        except Exception:
+            pass
+        # Return richer control metadata so LLM can choose type/click/select correctly.
+        # Один TreeWalker-проход по DOM вместо большого querySelectorAll: атрибуты
+        # читаются по разу, обход обрывается после 60 найденных элементов
+        elements = await evaluate_compiled(page, _PAGE_STRUCTURE_JS)
+        result = {'success': True, 'elements': elements, 'url': page.url}
     
     elif action == 'wait':
         selector = args.get('selector', '')
         timeout = args.get('timeout', 5000)
-        await pg.wait_for_selector(selector, timeout=timeout)
-        return {'success': True, 'found': selector}
+        await page.wait_for_selector(selector, timeout=timeout)
+        result = {'success': True, 'found': selector}
+    
+    elif action == 'get_console_logs':
+        log_entries = []
+        try:
+            cdp = await page.context.new_cdp_session(page)
+            def on_log(ev):
+                entry = ev.get('entry', ev) if isinstance(ev, dict) else {}
+                log_entries.append({
+                    'level': entry.get('level', ''),
+                    'text': entry.get('text', str(entry))[:500],
+                    'url': entry.get('url', '')[:200],
+                })
+            cdp.on('Log.entryAdded', on_log)
+            await cdp.send('Log.enable')
+            await asyncio.sleep(0.5)
+        except Exception as e:
+            result = {'success': False, 'error': str(e), 'url': page.url}
+        else:
+            result = {'success': True, 'logs': log_entries[:50], 'url': page.url}
+    
+    elif action == 'get_network_failures':
+        request_failures = []
+        bad_responses = []
+        def on_fail(req):
+            request_failures.append({'url': req.url[:300], 'failure': (getattr(req, 'failure', None) or 'request failed')})
+        def on_resp(resp):
+            if resp.status >= 400:
+                bad_responses.append({'url': resp.url[:300], 'status': resp.status})
+        page.on('requestfailed', on_fail)
+        page.on('response', on_resp)
+        await asyncio.sleep(2)
+        result = {
+            'success': True,
+            'request_failures': request_failures[:30],
+            'bad_status_responses': bad_responses[:30],
+            'url': page.url,
+        }
     
-    elif action == 'close':
-        if browser:
-            await browser.close()
-        return {'success': True, 'closed': True}
+    elif action == 'execute_script':
+        script = args.get('script', '')
+        try:
+            eval_result = await page.evaluate(script)
+            result = {'success': True, 'url': page.url, 'result': str(eval_result) if eval_result is not None else 'ok'}
+        except Exception as e:
+            result = {'success': False, 'error': str(e), 'url': page.url}
+    
+    elif action == 'scroll':
+        direction = (args.get('direction') or 'down').lower()
+        amount = int(args.get('amount') or 500)
+        to_bottom = args.get('to_bottom', False)
+        try:
+            if to_bottom:
+                await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
+            else:
+                delta = amount if direction == 'down' else -amount
+                await page.evaluate(f'window.scrollBy(0, {delta})')
+            result = {'success': True, 'url': page.url, 'scrolled': 'bottom' if to_bottom else direction}
+        except Exception as e:
+            result = {'success': False, 'error': str(e), 'url': page.url}
     
     else:
-        return {'success': False, 'error': f'Unknown action: {action}'}
+        result = {'success': False, 'error': f'Unknown action: {action}'}
 
+    return result
+'''
 
-async def main():
-    action = sys.argv[1]
-    args = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
-    
+# Постоянный сервер действий: держит одно Playwright-подключение к
+# keepalive-Chromium и принимает действия через UNIX-сокет — без запуска
+# интерпретатора и импорта Playwright на каждое действие
+BROWSER_SERVER_SCRIPT = '''#!/usr/bin/env python3
+"""Persistent browser action server: keeps one Playwright CDP connection and
+serves newline-delimited JSON requests over a UNIX socket."""
+import asyncio
+import json
+import sys
+import os
+from datetime import datetime
+
+SOCKET_PATH = '/tmp/browser_server.sock'
+# Файловый канал через bind-mounted /workspace: хост кладёт req_*.json напрямую
+# (без docker exec), сервер отвечает файлом res_*.json
+IPC_DIR = '/workspace/.browser_ipc'
+CDP_URL = "http://127.0.0.1:9222"
+STEALTH_SCRIPT = "Object.defineProperty(navigator, 'webdriver', { get: () => undefined }); window.chrome = { runtime: {} };"
+''' + _ACTION_DISPATCH_SRC + '''
+
+_pw = None
+_browser = None
+# Действия на одной странице выполняются строго по очереди
+_action_lock = asyncio.Lock()
+
+
+async def ensure_page():
+    """Connect to the keepalive browser (or launch one) and return its page."""
+    global _pw, _browser
+    if _pw is None:
+        from playwright.async_api import async_playwright
+        _pw = await async_playwright().start()
+    if _browser is None or not _browser.is_connected():
+        try:
+            _browser = await _pw.chromium.connect_over_cdp(CDP_URL, timeout=3000)
+        except Exception:
+            _browser = await _pw.chromium.launch(
+                headless=False,
+                args=[
+                    '--no-sandbox',
+                    '--disable-setuid-sandbox',
+                    '--disable-blink-features=AutomationControlled',
+                    '--disable-dev-shm-usage',
+                    '--remote-debugging-port=9222',
+                ]
+            )
+    contexts = _browser.contexts
+    if contexts and contexts[0].pages:
+        return contexts[0].pages[0]
+    if contexts:
+        context = contexts[0]
+    else:
+        context = await _browser.new_context(
+            viewport={'width': 1280, 'height': 720},
+            ignore_https_errors=True,
+            user_agent='Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        )
+        await context.add_init_script(STEALTH_SCRIPT)
+    return await context.new_page()
+
+
+async def process_request(req):
+    """Execute one request ({'action', 'args'} or {'batch': [...]}); never raises."""
     try:
-        result = await handle_action(action, args)
-        print(json.dumps(result))
+        if 'batch' in req:
+            # Пачка действий одной RPC; на одной странице — строго по очереди
+            results = []
+            async with _action_lock:
+                page = await ensure_page()
+                for item in req.get('batch') or []:
+                    act = item.get('action', '')
+                    try:
+                        r = await run_action(page, act, item.get('args') or {})
+                        r = await attach_failure_artifacts(page, act, r)
+                    except Exception as e:
+                        r = {'success': False, 'error': str(e)}
+                    results.append(r)
+            return {'success': True, 'results': results}
+        action = req.get('action', '')
+        async with _action_lock:
+            page = await ensure_page()
+            result = await run_action(page, action, req.get('args') or {})
+            return await attach_failure_artifacts(page, action, result)
     except Exception as e:
-        print(json.dumps({'success': False, 'error': str(e)}))
+        return {'success': False, 'error': str(e)}
+
+
+async def watch_ipc_dir():
+    """Poll IPC_DIR for host-written request files and answer them in place.
+
+    inotify в образе песочницы нет, поэтому дешёвый листинг каталога раз в
+    50 мс; хост и сервер пишут файлы атомарно (tmp + os.replace), так что
+    недописанный JSON здесь не встречается."""
+    os.makedirs(IPC_DIR, exist_ok=True)
+    while True:
+        try:
+            names = sorted(
+                n for n in os.listdir(IPC_DIR)
+                if n.startswith('req_') and n.endswith('.json')
+            )
+        except OSError:
+            names = []
+        for fname in names:
+            req_path = os.path.join(IPC_DIR, fname)
+            try:
+                with open(req_path, 'r') as f:
+                    req = json.loads(f.read())
+            except (OSError, ValueError):
+                continue
+            try:
+                os.unlink(req_path)
+            except OSError:
+                pass
+            result = await process_request(req)
+            req_id = fname[len('req_'):-len('.json')]
+            tmp_path = os.path.join(IPC_DIR, '.res_%s.tmp' % req_id)
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(json.dumps(result))
+                os.replace(tmp_path, os.path.join(IPC_DIR, 'res_%s.json' % req_id))
+            except OSError:
+                pass
+        await asyncio.sleep(0.05)
+
+
+async def handle_client(reader, writer):
+    """Serve one connection: one JSON request per line, one JSON response per line."""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line)
+            except ValueError:
+                req = {}
+            result = await process_request(req)
+            writer.write((json.dumps(result) + '\\n').encode())
+            await writer.drain()
+    except Exception:
+        pass
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+async def main():
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = await asyncio.start_unix_server(handle_client, path=SOCKET_PATH)
+    ipc_watcher = asyncio.create_task(watch_ipc_dir())
+    async with server:
+        await server.serve_forever()
+    ipc_watcher.cancel()
 
 
 if __name__ == '__main__':
     asyncio.run(main())
 '''
 
+# Тонкий клиент: stdlib-only, отправляет одно действие серверу через сокет.
+# Старт интерпретатора без импорта Playwright — десятки мс вместо ~0.5 с
+BROWSER_CLIENT_SCRIPT = '''#!/usr/bin/env python3
+"""Send one browser action to the persistent server over the UNIX socket."""
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = '/tmp/browser_server.sock'
+
+
+def main():
+    action = sys.argv[1]
+    if len(sys.argv) > 2 and os.path.isfile(sys.argv[2]):
+        with open(sys.argv[2], 'r') as f:
+            args = json.load(f)
+    else:
+        args = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
+    if action == '__batch__':
+        payload = {'batch': args}  # args — список {'action', 'args'}
+    else:
+        payload = {'action': action, 'args': args}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(55)
+    sock.connect(SOCKET_PATH)
+    sock.sendall((json.dumps(payload) + '\\n').encode())
+    buf = b''
+    while not buf.endswith(b'\\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    sys.stdout.write(buf.decode())
+
+
+if __name__ == '__main__':
+    main()
+'''
+
 # Скрипт, который только запускает Chromium с CDP и не завершается — чтобы окно было видно в noVNC
 BROWSER_KEEPALIVE_SCRIPT = '''#!/usr/bin/env python3
 """Keep Chromium running with CDP so noVNC shows the browser window."""
@@ -209,8 +716,8 @@ import asyncio
 import json
 import sys
 import os
-import base64
 from datetime import datetime
+''' + _ACTION_DISPATCH_SRC + '''
 
 async def main():
     action = sys.argv[1]
@@ -230,29 +737,6 @@ async def main():
         page = None
         connected_to_existing = False
 
-        async def attach_failure_artifacts(result_obj):
-            """Attach debug metadata for failed actions so incidents are easier to investigate."""
-            if not isinstance(result_obj, dict) or result_obj.get('success', True):
-                return result_obj
-            if not page:
-                return result_obj
-
-            try:
-                screenshots_dir = '/workspace/.screenshots'
-                os.makedirs(screenshots_dir, exist_ok=True)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                debug_path = f'{screenshots_dir}/failure_{action}_{timestamp}.png'
-                await page.screenshot(path=debug_path, full_page=True)
-                result_obj['debug_screenshot_path'] = debug_path.replace('/workspace/', '')
-            except Exception:
-                pass
-
-            try:
-                result_obj['url'] = page.url
-                result_obj['title'] = await page.title()
-            except Exception:
-                pass
-            return result_obj
         
         # Try to connect to existing browser
         try:
@@ -289,330 +773,56 @@ async def main():
         if not page:
             context = browser.contexts[0] if browser.contexts else await browser.new_context()
             page = await context.new_page()
-        
-        try:
-            if action == 'navigate':
-                url = args.get('url', '')
-                timeout = int(args.get('timeout', 30000))
-                await page.goto(url, wait_until='domcontentloaded', timeout=timeout)
-                await asyncio.sleep(0.6)
-                result = {'success': True, 'url': page.url, 'title': await page.title()}
-            
-            elif action == 'click':
-                selector = args.get('selector', '')
-                timeout = int(args.get('timeout', 5000))
-                last_err = None
-                done = False
-                for attempt in range(2):
-                    try:
-                        if attempt == 1:
-                            await page.wait_for_selector(selector, state='visible', timeout=min(timeout, 2000))
-                        await page.click(selector, timeout=timeout)
-                        done = True
-                        break
-                    except Exception as e1:
-                        last_err = e1
-                        try:
-                            await page.click('text="' + selector.replace('"', '\\\\"') + '"', timeout=timeout)
-                            done = True
-                            break
-                        except Exception as e2:
-                            last_err = e2
-                            try:
-                                await page.get_by_text(selector, exact=False).first.click(timeout=timeout)
-                                done = True
-                                break
-                            except Exception as e3:
-                                last_err = e3
-                    if not done and attempt == 0:
-                        await asyncio.sleep(0.8)
-                if done:
-                    await asyncio.sleep(0.25)
-                    result = {'success': True, 'clicked': selector, 'url': page.url}
-                else:
-                    result = {'success': False, 'error': 'Element not found: %s. %s' % (selector, last_err)}
-            
-            elif action == 'type':
-                selector = args.get('selector', '')
-                text = args.get('text', '')
-                timeout = int(args.get('timeout', 5000))
-                last_err = None
-                done = False
-                for attempt in range(2):
-                    try:
-                        await page.fill(selector, text, timeout=timeout)
-                        done = True
-                        break
-                    except Exception as e:
-                        last_err = e
-                    if not done and attempt == 0:
-                        await asyncio.sleep(0.8)
-                if done:
-                    result = {'success': True, 'typed': text, 'selector': selector}
-                else:
-                    result = {'success': False, 'error': 'Input not found: %s. %s' % (selector, last_err)}
-            
-            elif action == 'fill_form':
-                steps = args.get('steps', [])
-                submit_selector = args.get('submit_selector', '')
-                errors = []
-                applied = []
-                for i, step in enumerate(steps):
-                    sel = step.get('selector', '')
-                    val = step.get('value', '')
-                    if not sel:
-                        continue
-                    try:
-                        field_meta = await page.evaluate("""(selector) => {
-                            const el = document.querySelector(selector);
-                            if (!el) return { exists: false };
-                            const tag = (el.tagName || '').toLowerCase();
-                            const role = ((el.getAttribute('role') || '') + '').toLowerCase();
-                            return {
-                                exists: true,
-                                tag,
-                                role,
-                                inputType: ((el.type || '') + '').toLowerCase(),
-                                isSelect: tag === 'select',
-                                isNativeMultiSelect: tag === 'select' && !!el.multiple,
-                                isAriaMultiSelect: ['listbox', 'combobox'].includes(role) &&
-                                    ((el.getAttribute('aria-multiselectable') || '') + '').toLowerCase() === 'true',
-                            };
-                        }""", sel)
-
-                        if not field_meta or not field_meta.get('exists'):
-                            raise Exception('element not found')
-
-                        requested_type = (step.get('type') or '').lower()
-                        wants_select = requested_type in ('select', 'dropdown', 'multiselect')
-                        is_selectish = field_meta.get('isSelect') or field_meta.get('role') in ('combobox', 'listbox')
-                        is_multi = field_meta.get('isNativeMultiSelect') or field_meta.get('isAriaMultiSelect') or requested_type == 'multiselect'
-
-                        if wants_select or is_selectish:
-                            selected = False
-                            if step.get('values') and isinstance(step.get('values'), list):
-                                await page.select_option(sel, [str(v) for v in step.get('values')])
-                                selected = True
-                            elif step.get('value'):
-                                if is_multi and isinstance(step.get('value'), str) and ',' in step.get('value'):
-                                    values = [x.strip() for x in step.get('value').split(',') if x.strip()]
-                                    if values:
-                                        await page.select_option(sel, values)
-                                        selected = True
-                                if not selected:
-                                    await page.select_option(sel, value=str(step['value']))
-                                    selected = True
-                            elif step.get('label'):
-                                await page.select_option(sel, label=str(step['label']))
-                                selected = True
 
-                            if not selected:
-                                raise Exception('select field requires value/values/label')
-                            applied.append({'selector': sel, 'mode': 'multiselect' if is_multi else 'select'})
-                        else:
-                            await page.fill(sel, str(val))
-                            applied.append({'selector': sel, 'mode': 'text'})
-                    except Exception as e:
-                        errors.append('%s: %s' % (sel, e))
-                if submit_selector:
-                    try:
-                        await page.click(submit_selector, timeout=5000)
-                        await asyncio.sleep(0.4)
-                    except Exception as e:
-                        errors.append('submit %s: %s' % (submit_selector, e))
-                if errors:
-                    result = {'success': False, 'error': '; '.join(errors), 'url': page.url, 'applied': applied}
-                else:
-                    result = {'success': True, 'filled': len(steps), 'url': page.url, 'applied': applied}
-            
-            elif action == 'select':
-                selector = args.get('selector', '')
-                value = args.get('value', '')
-                label = args.get('label', '')
-                try:
-                    if value:
-                        await page.select_option(selector, value=value)
-                        result = {'success': True, 'selector': selector, 'url': page.url}
-                    elif label:
-                        await page.select_option(selector, label=label)
-                        result = {'success': True, 'selector': selector, 'url': page.url}
-                    else:
-                        result = {'success': False, 'error': 'Provide value or label for select'}
-                except Exception as e:
-                    result = {'success': False, 'error': 'Select failed: %s. %s' % (selector, e)}
-            
-            elif action == 'screenshot':
-                full_page = args.get('full_page', False)
-                screenshot = await page.screenshot(full_page=full_page, type='png')
-                screenshot_b64 = base64.b64encode(screenshot).decode('utf-8')
-                screenshots_dir = '/workspace/.screenshots'
-                os.makedirs(screenshots_dir, exist_ok=True)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                path = f'{screenshots_dir}/screenshot_{timestamp}.png'
-                with open(path, 'wb') as f:
-                    f.write(screenshot)
-                page_text = (await page.evaluate('document.body.innerText')).strip() if page else ''
-                result = {
-                    'success': True,
-                    'screenshot': screenshot_b64,
-                    'screenshot_path': path.replace('/workspace/', ''),
-                    'page_text': (page_text or '')[:5000],
-                }
-            
-            elif action == 'get_content':
-                selector = args.get('selector', '')
-                if selector:
-                    text = await page.text_content(selector)
-                else:
-                    text = await page.evaluate('document.body.innerText')
-                result = {'success': True, 'content': (text or '')[:5000], 'url': page.url}
-            
-            elif action == 'get_page_structure':
-                await page.wait_for_load_state('domcontentloaded')
-                await asyncio.sleep(0.4)
-                # Return richer control metadata so LLM can choose type/click/select correctly.
-                elements = await page.evaluate("""() => {
-                    const out = [];
-                    const asSelector = (el) => {
-                        if (el.id) return '#' + CSS.escape(el.id);
-                        if (el.name && /^(input|textarea|select)$/i.test(el.tagName)) {
-                            return el.tagName.toLowerCase() + '[name="' + (el.name || '').replace(/"/g, '\\\\"') + '"]';
-                        }
-                        const dt = el.getAttribute('data-testid') || el.getAttribute('data-test') || el.getAttribute('data-qa');
-                        if (dt) return '[data-testid="' + dt.replace(/"/g, '\\\\"') + '"]';
-                        if (el.type && el.tagName === 'INPUT') return 'input[type="' + el.type + '"]';
-                        return el.tagName.toLowerCase();
-                    };
-                    const visible = (el) => !!(el.offsetParent || (el.getClientRects && el.getClientRects().length));
-                    const roleOf = (el) => ((el.getAttribute('role') || '') + '').toLowerCase();
-                    const textOf = (el) => ((el.value !== undefined ? el.value : el.innerText) || '').trim();
-
-                    document.querySelectorAll('input, textarea, select, button, [role="button"], [role="combobox"], [role="listbox"], a[href]').forEach(el => {
-                        if (!visible(el)) return;
-                        const tag = (el.tagName || '').toLowerCase();
-                        const role = roleOf(el);
-                        const type = ((el.type || '') + '').toLowerCase();
-                        const isSelect = tag === 'select';
-                        const isNativeMultiSelect = isSelect && !!el.multiple;
-                        const isRoleCombo = role === 'combobox';
-                        const isRoleListbox = role === 'listbox';
-                        const isAriaMultiSelect = (isRoleCombo || isRoleListbox) && (((el.getAttribute('aria-multiselectable') || '') + '').toLowerCase() === 'true');
-                        const optionsCount = isSelect ? el.options.length : Number(el.getAttribute('aria-setsize') || 0) || null;
-
-                        out.push({
-                            kind: tag === 'a' ? 'link' : tag,
-                            selector: asSelector(el),
-                            tag,
-                            role: role || null,
-                            control_type: isNativeMultiSelect || isAriaMultiSelect ? 'multiselect' : (isSelect || isRoleCombo || isRoleListbox ? 'select' : 'input'),
-                            type: type || null,
-                            name: el.name || null,
-                            placeholder: (el.placeholder || '').slice(0, 60) || null,
-                            label: (el.getAttribute('aria-label') || el.title || (el.closest('label') && el.closest('label').innerText) || '').trim().slice(0, 80),
-                            text: textOf(el).slice(0, 60) || null,
-                            is_select: isSelect || isRoleCombo || isRoleListbox,
-                            is_multiselect: isNativeMultiSelect || isAriaMultiSelect,
-                            options_count: optionsCount,
-                        });
-                    });
-                    return out.slice(0, 60);
-                }""")
-                result = {'success': True, 'elements': elements, 'url': page.url}
-            
-            elif action == 'wait':
-                selector = args.get('selector', '')
-                timeout = args.get('timeout', 5000)
-                await page.wait_for_selector(selector, timeout=timeout)
-                result = {'success': True, 'found': selector}
-            
-            elif action == 'get_console_logs':
-                log_entries = []
-                try:
-                    cdp = await page.context.new_cdp_session(page)
-                    def on_log(ev):
-                        entry = ev.get('entry', ev) if isinstance(ev, dict) else {}
-                        log_entries.append({
-                            'level': entry.get('level', ''),
-                            'text': entry.get('text', str(entry))[:500],
-                            'url': entry.get('url', '')[:200],
-                        })
-                    cdp.on('Log.entryAdded', on_log)
-                    await cdp.send('Log.enable')
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    result = {'success': False, 'error': str(e), 'url': page.url}
-                else:
-                    result = {'success': True, 'logs': log_entries[:50], 'url': page.url}
-            
-            elif action == 'get_network_failures':
-                request_failures = []
-                bad_responses = []
-                def on_fail(req):
-                    request_failures.append({'url': req.url[:300], 'failure': (getattr(req, 'failure', None) or 'request failed')})
-                def on_resp(resp):
-                    if resp.status >= 400:
-                        bad_responses.append({'url': resp.url[:300], 'status': resp.status})
-                page.on('requestfailed', on_fail)
-                page.on('response', on_resp)
-                await asyncio.sleep(2)
-                result = {
-                    'success': True,
-                    'request_failures': request_failures[:30],
-                    'bad_status_responses': bad_responses[:30],
-                    'url': page.url,
-                }
-            
-            elif action == 'execute_script':
-                script = args.get('script', '')
-                try:
-                    eval_result = await page.evaluate(script)
-                    result = {'success': True, 'url': page.url, 'result': str(eval_result) if eval_result is not None else 'ok'}
-                except Exception as e:
-                    result = {'success': False, 'error': str(e), 'url': page.url}
-            
-            elif action == 'scroll':
-                direction = (args.get('direction') or 'down').lower()
-                amount = int(args.get('amount') or 500)
-                to_bottom = args.get('to_bottom', False)
-                try:
-                    if to_bottom:
-                        await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
-                    else:
-                        delta = amount if direction == 'down' else -amount
-                        await page.evaluate(f'window.scrollBy(0, {delta})')
-                    result = {'success': True, 'url': page.url, 'scrolled': 'bottom' if to_bottom else direction}
-                except Exception as e:
-                    result = {'success': False, 'error': str(e), 'url': page.url}
-            
-            else:
-                result = {'success': False, 'error': f'Unknown action: {action}'}
-
-            result = await attach_failure_artifacts(result)
-            
+        try:
+            result = await run_action(page, action, args)
+            result = await attach_failure_artifacts(page, action, result)
             print(json.dumps(result))
-        
         except Exception as e:
             print(json.dumps({'success': False, 'error': str(e)}))
-        
+
         # DON'T close browser — keep it running for next action!
         # Only disconnect the CDP connection
         if connected_to_existing:
             pass  # Don't close, just let the script end
 
+
 if __name__ == '__main__':
     asyncio.run(main())
 '''
 
 
+# SHA-256 исходников скриптов — считается один раз на импорт модуля
+_SCRIPT_SOURCES = {
+    "/tmp/browser_ping.py": BROWSER_PING_SCRIPT,
+    "/tmp/browser_keepalive.py": BROWSER_KEEPALIVE_SCRIPT,
+    "/tmp/browser_action.py": BROWSER_ACTION_SCRIPT,
+    "/tmp/browser_server.py": BROWSER_SERVER_SCRIPT,
+    "/tmp/browser_client.py": BROWSER_CLIENT_SCRIPT,
+}
+_SCRIPT_SHAS = {
+    path: hashlib.sha256(src.encode()).hexdigest()
+    for path, src in _SCRIPT_SOURCES.items()
+}
+
+
 class BrowserTools:
     """Browser automation tools using Playwright in the sandbox."""
 
+    # Какие версии скриптов уже лежат в контейнере ("path:sha"); класс-уровень,
+    # переживает пересоздание BrowserTools для того же контейнера
+    _container_scripts: dict = {}
+
     def __init__(self, project_id: str):
         self.project_id = project_id
         # Cache browser readiness checks to avoid expensive ping+exec on every action.
         self._last_browser_check_ts = 0.0
         self._browser_check_ttl_sec = 15.0
-        self._browser_action_script_ready = False
+        self._browser_server_ready = False
+        # Очередь коалесценции: параллельные действия уходят одной RPC
+        self._action_queue: asyncio.Queue = asyncio.Queue()
+        self._flusher_task = None
+        self._ipc_seq = 0
 
     def _should_check_browser(self) -> bool:
         """Return True when it's time to re-check keepalive browser availability."""
@@ -622,19 +832,43 @@ class BrowserTools:
         """Record the last moment browser keepalive was checked/launched."""
         self._last_browser_check_ts = time.monotonic()
 
+    async def _materialize_script(self, path: str, force: bool = False) -> None:
+        """Записать скрипт в контейнер, только если там ещё нет этой версии.
+
+        Сначала кэш в памяти, затем (один раз на контейнер) sha256sum в
+        контейнере — повторные заливки одинаковых байт пропускаются.
+        """
+        sha = _SCRIPT_SHAS[path]
+        key = f"{path}:{sha}"
+        known = self._container_scripts.setdefault(self.project_id, set())
+        if not force and key in known:
+            return
+        if not force:
+            res = await docker_manager.exec_command(
+                self.project_id, f"sha256sum {path}", workdir="/workspace", timeout=5
+            )
+            if (res.get("stdout") or "").split()[:1] == [sha]:
+                known.add(key)
+                return
+        await docker_manager.write_file(self.project_id, path, _SCRIPT_SOURCES[path])
+        known.add(key)
+
     async def _ensure_browser_running(self, force: bool = False) -> None:
         """Запустить в контейнере постоянный процесс с браузером (если ещё не запущен), чтобы окно было видно в noVNC."""
         if not force and not self._should_check_browser():
             return
 
-        await docker_manager.write_file(self.project_id, "/tmp/browser_ping.py", BROWSER_PING_SCRIPT)
+        await self._materialize_script("/tmp/browser_ping.py")
         ping = await docker_manager.exec_command(
             self.project_id, "python3 /tmp/browser_ping.py", workdir="/workspace", timeout=5
         )
         if ping.get("stdout", "").strip() == "OK":
             self._mark_browser_checked()
             return
-        await docker_manager.write_file(self.project_id, "/tmp/browser_keepalive.py", BROWSER_KEEPALIVE_SCRIPT)
+        # Браузер не отвечает — возможно, контейнер пересоздан и /tmp пуст;
+        # кэш скриптов для проекта больше не достоверен
+        self._container_scripts.pop(self.project_id, None)
+        await self._materialize_script("/tmp/browser_keepalive.py")
         await docker_manager.exec_command(
             self.project_id,
             "sh -c 'nohup python3 /tmp/browser_keepalive.py </dev/null >/tmp/browser_keepalive.log 2>&1 &'",
@@ -659,23 +893,214 @@ class BrowserTools:
         return out
 
     async def _ensure_action_script(self, force: bool = False) -> None:
-        """Write browser action script once per engine instance (or force rewrite)."""
-        if self._browser_action_script_ready and not force:
+        """Write browser action script unless the container already has this version."""
+        await self._materialize_script("/tmp/browser_action.py", force=force)
+
+    async def _ensure_server_running(self, force: bool = False) -> None:
+        """Записать и запустить постоянный сервер действий (один раз на инстанс)."""
+        if self._browser_server_ready and not force:
             return
-        await docker_manager.write_file(
-            self.project_id, "/tmp/browser_action.py", BROWSER_ACTION_SCRIPT
+        await self._materialize_script("/tmp/browser_server.py", force=force)
+        await self._materialize_script("/tmp/browser_client.py", force=force)
+        await docker_manager.exec_command(
+            self.project_id,
+            "sh -c 'nohup python3 /tmp/browser_server.py </dev/null >/tmp/browser_server.log 2>&1 &'",
+            workdir="/workspace",
+            timeout=5,
+        )
+        # Сокет поднимается почти сразу; Playwright сервер импортирует лениво
+        # при первом действии
+        await asyncio.sleep(0.5)
+        self._browser_server_ready = True
+
+    def _host_ipc_dir(self) -> str:
+        """Каталог файлового канала со стороны хоста (bind mount /workspace,
+        тот же путь, что create_sandbox отдаёт Docker как volume)."""
+        return os.path.abspath(
+            os.path.join(settings.PROJECTS_DIR, self.project_id, ".browser_ipc")
         )
-        self._browser_action_script_ready = True
+
+    async def _try_ipc_action(self, payload: dict, timeout: float = 60.0) -> dict | None:
+        """Самый быстрый путь: запрос и ответ файлами в bind-mounted каталоге —
+        ни одного docker exec. None → fallback на сокетный клиент."""
+        ipc_dir = self._host_ipc_dir()
+        if not os.path.isdir(ipc_dir):
+            return None  # сервер ещё не создал каталог — канал не готов
+        self._ipc_seq += 1
+        req_id = f"{os.getpid()}_{self._ipc_seq}"
+        req_path = os.path.join(ipc_dir, f"req_{req_id}.json")
+        res_path = os.path.join(ipc_dir, f"res_{req_id}.json")
+        tmp_path = os.path.join(ipc_dir, f".req_{req_id}.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(payload, ensure_ascii=False))
+            os.replace(tmp_path, req_path)  # атомарно: сервер не увидит недописанный JSON
+        except OSError:
+            return None
+        start = time.monotonic()
+        delay = 0.01
+        try:
+            while time.monotonic() - start < timeout:
+                if os.path.exists(res_path):
+                    try:
+                        with open(res_path, "r") as f:
+                            out = json.loads(f.read())
+                    except (OSError, ValueError):
+                        return None
+                    return out if isinstance(out, dict) else None
+                if os.path.exists(req_path) and time.monotonic() - start > 2.0:
+                    return None  # сервер не забрал запрос — он не работает
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            return None
+        finally:
+            for path in (req_path, res_path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    async def _try_server_action(self, action: str) -> dict | None:
+        """Быстрый путь: действие через постоянный сервер. None → fallback
+        на одноразовый скрипт (сервер не поднялся/не отвечает)."""
+        for attempt in range(2):
+            result = await docker_manager.exec_command(
+                self.project_id,
+                f"python3 /tmp/browser_client.py {action} /tmp/browser_action_args.json",
+                workdir="/workspace",
+                timeout=60,
+            )
+            output = (result.get("stdout") or "").strip()
+            if result.get("success") and output:
+                try:
+                    out = json.loads(output.splitlines()[-1])
+                except json.JSONDecodeError:
+                    return None
+                if isinstance(out, dict):
+                    return out
+                return None
+            if attempt == 0:
+                # Клиент/сервер ещё не записаны или сервер умер — поднять и повторить
+                await self._ensure_server_running(force=True)
+        return None
+
+    def _log_action_result(self, action: str, out: dict) -> None:
+        """Единый лог результата действия для обоих путей выполнения."""
+        url = out.get("url", "")
+        success = out.get("success", False)
+        err = out.get("error", "")
+        extra = f" url={url[:60]}" if url else ""
+        if err:
+            print(f"[Browser] action={action} success={success} error={str(err)[:120]}")
+        else:
+            print(f"[Browser] action={action} success={success}{extra}")
 
     async def _execute_browser_script(self, action: str, args: dict) -> dict:
+        """Поставить действие в очередь: параллельные вызовы коалесцируются
+        в одну RPC к серверу (см. _batch_flusher)."""
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.create_task(self._batch_flusher())
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        await self._action_queue.put((action, args, fut))
+        return await fut
+
+    async def close(self) -> None:
+        """Остановить фоновый flusher (иначе asyncio держит задачу — и весь
+        объект — живыми вечно). Зовётся при выселении executor'а проекта."""
+        task, self._flusher_task = self._flusher_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        # Действия, не успевшие уйти в RPC, получают явный отказ
+        while not self._action_queue.empty():
+            _, _, fut = self._action_queue.get_nowait()
+            if not fut.done():
+                fut.set_result({"success": False, "error": "Browser tools closed"})
+
+    async def _batch_flusher(self) -> None:
+        """Фоновая корутина: собирает действия, пришедшие в течение ~10 мс,
+        и отправляет их одной RPC вместо отдельного exec на каждое."""
+        while True:
+            item = await self._action_queue.get()
+            batch = [item]
+            await asyncio.sleep(0.01)  # окно коалесценции
+            while not self._action_queue.empty():
+                batch.append(self._action_queue.get_nowait())
+            if len(batch) == 1:
+                action, args, fut = batch[0]
+                try:
+                    result = await self._execute_one(action, args)
+                except Exception as e:
+                    result = {"success": False, "error": str(e)}
+                if not fut.done():
+                    fut.set_result(result)
+                continue
+            try:
+                results = await self._execute_batch(batch)
+            except Exception as e:
+                results = [{"success": False, "error": str(e)}] * len(batch)
+            for (_, _, fut), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res)
+
+    async def _execute_batch(self, batch: list) -> list:
+        """Одна RPC на пачку действий (сервер выполняет их по очереди на
+        странице). Если сервер недоступен — по одному через fallback-путь."""
+        await self._ensure_browser_running()
+        for action, args, _ in batch:
+            print(f"[Browser] project={self.project_id} action={action} args={self._log_args(args)} (batch)")
+        items = [{"action": a, "args": g} for a, g, _ in batch]
+
+        if self._browser_server_ready:
+            out = await self._try_ipc_action({"batch": items}, timeout=120.0)
+            results = out.get("results") if isinstance(out, dict) else None
+            if isinstance(results, list) and len(results) == len(batch):
+                for (action, _, _), res in zip(batch, results):
+                    if isinstance(res, dict):
+                        self._log_action_result(action, res)
+                return results
+
+        payload = json.dumps(items, ensure_ascii=False)
+        await docker_manager.write_file(
+            self.project_id, "/tmp/browser_action_args.json", payload
+        )
+        out = await self._try_server_action("__batch__")
+        results = out.get("results") if isinstance(out, dict) else None
+        if isinstance(results, list) and len(results) == len(batch):
+            for (action, _, _), res in zip(batch, results):
+                if isinstance(res, dict):
+                    self._log_action_result(action, res)
+            return results
+        return [await self._execute_one(a, g) for a, g, _ in batch]
+
+    async def _execute_one(self, action: str, args: dict) -> dict:
         """Execute Playwright script in the sandbox."""
         await self._ensure_browser_running()
         print(f"[Browser] project={self.project_id} action={action} args={self._log_args(args)}")
-        await self._ensure_action_script()
+
+        # Файловый канал через bind mount: доступен после первого подъёма сервера
+        if self._browser_server_ready:
+            out = await self._try_ipc_action({"action": action, "args": args})
+            if out is not None:
+                self._log_action_result(action, out)
+                return out
+
         args_json = json.dumps(args, ensure_ascii=False)
         await docker_manager.write_file(
             self.project_id, "/tmp/browser_action_args.json", args_json
         )
+
+        # Быстрый путь: постоянный сервер (без старта интерпретатора с Playwright
+        # на каждое действие). При любой проблеме — прежний одноразовый скрипт.
+        out = await self._try_server_action(action)
+        if out is not None:
+            self._log_action_result(action, out)
+            return out
+
+        await self._ensure_action_script()
         command = f"python3 /tmp/browser_action.py {action} /tmp/browser_action_args.json"
         result = await docker_manager.exec_command(
             self.project_id,
@@ -751,14 +1176,7 @@ class BrowserTools:
                 # Fallback: try parsing the whole stdout as JSON
                 out = json.loads(output)
 
-            url = out.get("url", "")
-            success = out.get("success", False)
-            err = out.get("error", "")
-            extra = f" url={url[:60]}" if url else ""
-            if err:
-                print(f"[Browser] action={action} success={success} error={str(err)[:120]}")
-            else:
-                print(f"[Browser] action={action} success={success}{extra}")
+            self._log_action_result(action, out)
             return out
         except json.JSONDecodeError as e:
             print(f"[Browser] action={action} parse_error={e}")
@@ -14,6 +14,45 @@ from agents.tools.browser_tools import BrowserTools
 class ToolExecutor:
     """Executes tool calls inside a project's Docker sandbox."""
 
+    # Shared executors per project: construction walks dir(self) and calls
+    # inspect.signature for every handler, so parallel subtask waves reuse
+    # one pooled instance instead of paying that per subtask.
+    _pool: dict[str, "ToolExecutor"] = {}
+
+    @classmethod
+    def get(cls, project_id: str) -> "ToolExecutor":
+        """Get (or lazily create) the shared executor for a project."""
+        executor = cls._pool.get(project_id)
+        if executor is None:
+            executor = cls._pool[project_id] = cls(project_id)
+        return executor
+
+    @classmethod
+    async def evict(cls, project_id: str) -> None:
+        """Drop the pooled executor and release its resources (browser
+        flusher task, file caches). The pool has no TTL of its own, so
+        the sandbox/engine cleanup paths must call this — otherwise every
+        project that ever ran a task stays pinned for the server's life.
+        """
+        executor = cls._pool.pop(project_id, None)
+        if executor is not None:
+            try:
+                await executor.browser_tools.close()
+            except Exception as e:
+                print(f"⚠️ Executor eviction error for {project_id}: {e}")
+
+    @classmethod
+    async def evict_all(cls) -> None:
+        """Evict every pooled executor (server-wide sandbox teardown)."""
+        for project_id in list(cls._pool):
+            await cls.evict(project_id)
+
+    @classmethod
+    async def evict_stale(cls, live_project_ids: set) -> None:
+        """Evict executors whose project no longer has a sandbox."""
+        for project_id in [p for p in cls._pool if p not in live_project_ids]:
+            await cls.evict(project_id)
+
     def __init__(self, project_id: str):
         self.project_id = project_id
         self.browser_tools = BrowserTools(project_id)
@@ -240,15 +279,14 @@ class ToolExecutor:
     async def _tool_browser_screenshot(self, full_page: bool = False) -> dict:
         """Take screenshot of browser. Also returns page text so non-vision models can analyze."""
         result = await self.browser_tools.screenshot(full_page)
-        screenshot_b64 = result.get("screenshot", "")
         screenshot_path = result.get("screenshot_path", "")
         page_text = result.get("page_text", "")
         return {
             "success": result.get("success", False),
-            "has_screenshot": bool(screenshot_b64),
+            "has_screenshot": bool(screenshot_path),
             "screenshot_path": screenshot_path,
             "page_text": page_text,
-            "size_bytes": len(screenshot_b64) if screenshot_b64 else 0,
+            "size_bytes": result.get("size_bytes", 0),
             "error": result.get("error"),
         }
 
@@ -62,6 +62,8 @@ class Settings(BaseSettings):
     AGENT_MAX_ITERATIONS: int = 50  # Base iteration budget for the main agent loop
     AGENT_SUBTASK_MAX_ITERATIONS: int = 25  # Iteration budget for each parallel subtask engine
     AGENT_ITERATION_EXTENSION: int = 20  # Extra iterations when limit is reached but work is still progressing
+    PLAN_CACHE_ENABLED: bool = False  # Повторный идентичный запрос берёт план из кэша (без вызова LLM)
+    PLAN_TRIVIAL_SHORTCIRCUIT: bool = True  # Короткая задача без союзов — план из одной подзадачи без вызова LLM ("#plan" в тексте форсирует планировщик)
 
     # ============================================
     # Redis (optional, for sessions/caching)
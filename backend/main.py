@@ -21,6 +21,7 @@ import mimetypes
 from config import settings
 from docker_manager.manager import docker_manager
 from agents.engine import AgentEngine, AgentStep
+from agents.tools.executor import ToolExecutor
 from llm.router import llm_router
 from database import init_db, get_db
 from models import User, Project
@@ -47,6 +48,13 @@ async def periodic_cleanup():
         await asyncio.sleep(300)  # Every 5 minutes
         try:
             removed = await docker_manager.cleanup_idle_sandboxes()
+            if removed:
+                # Engines and pooled executors must not outlive their
+                # sandbox — neither collection has a TTL of its own
+                alive = {sb["project_id"] for sb in docker_manager.list_sandboxes()}
+                for pid in [p for p in agent_engines if p not in alive]:
+                    agent_engines.pop(pid, None)
+                await ToolExecutor.evict_stale(alive)
         except Exception as e:
             print(f"⚠️ Cleanup error: {e}")
 
@@ -336,6 +344,7 @@ async def delete_project(project_id: str):
     """Delete a project and its sandbox."""
     await docker_manager.destroy_sandbox(project_id)
     agent_engines.pop(project_id, None)
+    await ToolExecutor.evict(project_id)
     return {"status": "deleted", "project_id": project_id}
 
 
@@ -509,8 +518,9 @@ async def list_sandboxes():
 async def destroy_sandbox(project_id: str):
     """Destroy a specific sandbox."""
     await docker_manager.destroy_sandbox(project_id)
-    # Also clean up agent engine
+    # Also clean up agent engine and its pooled executor
     agent_engines.pop(project_id, None)
+    await ToolExecutor.evict(project_id)
     return {"status": "destroyed", "project_id": project_id}
 
 
@@ -526,6 +536,7 @@ async def destroy_all_sandboxes():
     """Destroy ALL sandboxes."""
     await docker_manager.destroy_all_sandboxes()
     agent_engines.clear()
+    await ToolExecutor.evict_all()
     return {"status": "all_destroyed"}
 
 
@@ -1140,9 +1151,20 @@ async def telegram_webhook(request: dict):
 
 if __name__ == "__main__":
     import uvicorn
+    # uvloop (ships with uvicorn[standard]) is noticeably faster than the
+    # stdlib event loop for the websocket/subprocess churn this app does;
+    # request it explicitly so a stripped install falls back loudly here
+    # instead of silently running the slower loop.
+    try:
+        import uvloop  # noqa: F401
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+        print("⚠️ uvloop не установлен — используется стандартный event loop")
     uvicorn.run(
         "main:app",
         host=settings.HOST,
         port=settings.PORT,
         reload=settings.DEBUG,
+        loop=loop_impl,
     )